@@ -123,7 +123,7 @@ def load_s3_data(bucket_name, file_name):
     elif fnmatch(file_name, "*.parquet"):
         return pd.read_parquet("s3://" + bucket_name + "/" + file_name)
     elif fnmatch(file_name, "*.pkl") or fnmatch(file_name, "*.pickle"):
-        file = obj.get()["Body"].read().decode()
+        file = obj.get()["Body"].read()
         return pickle.loads(file)
     elif (
         fnmatch(file_name, "*.jpg")
@@ -155,6 +155,34 @@ def dictionary_to_s3(data_dict: dict, s3_bucket: str, s3_folder: str, file_name:
     s3_client.upload_fileobj(obj, s3_bucket, os.path.join(s3_folder, file_name))
 
 
+def bytes_to_s3(data: bytes, s3_bucket: str, s3_folder: str, file_name: str):
+    """
+    Uploads already serialised data (e.g. json bytes) to S3.
+    Args:
+        data: serialised data
+        s3_bucket: S3 bucket name where to upload the file
+        s3_folder: folder where to store the file within the S3 bucket
+        file_name: name of the file
+    """
+    s3_client = boto3.client("s3")
+    s3_client.upload_fileobj(
+        io.BytesIO(data), s3_bucket, os.path.join(s3_folder, file_name)
+    )
+
+
+def load_s3_bytes(bucket_name: str, file_name: str) -> bytes:
+    """
+    Loads the raw bytes of a file from S3, without parsing them.
+
+    Args:
+        bucket_name: The S3 bucket name
+        file_name: S3 key to load
+    """
+    s3 = get_s3_resource()
+
+    return s3.Object(bucket_name, file_name).get()["Body"].read()
+
+
 def save_json_to_local_inputs_folder(data_dict: dict, folder: str, file_name: str):
     """
     Saves json file to local inputs folder.
@@ -208,24 +236,120 @@ def read_json_from_local_path(file_path: str) -> dict:
     return data
 
 
-def get_s3_data_paths(bucket_name, root, file_types=["*.jsonl"]):
+def list_s3_partitions(bucket_name: str, prefix: str, partition: str) -> List[str]:
+    """
+    Lists the values of a partition (e.g. tag=...) directly below a prefix,
+    without listing the objects inside the partitions.
+
+    Args:
+        bucket_name: The S3 bucket name
+        prefix: folder containing the partitions
+        partition: name of the partition
+    Returns:
+        Sorted partition values.
+    """
+    paginator = boto3.client("s3").get_paginator("list_objects_v2")
+    partition_prefix = f"{prefix}{partition}="
+
+    values = []
+    for page in paginator.paginate(
+        Bucket=bucket_name, Prefix=partition_prefix, Delimiter="/"
+    ):
+        for common_prefix in page.get("CommonPrefixes", []):
+            values.append(common_prefix["Prefix"][len(partition_prefix) : -1])
+
+    return sorted(values)
+
+
+def get_s3_data_paths(
+    bucket_name,
+    root,
+    file_types=["*.jsonl"],
+    env=None,
+    tags=None,
+    start_date=None,
+    end_date=None,
+    recursive=True,
+):
     """
     Get all paths to particular file types in a S3 root location
 
+    If any of env, tags, start_date or end_date are given, root is treated as
+    a folder partitioned as env=/tag=/date=/ (e.g. RAW_DATA_COLLECTION_FOLDER)
+    and only the matching partitions are listed.
+
     bucket_name: The S3 bucket name
     root: The root folder to look for files in
     file_types: List of file types to look for, or one
+    env: environment partition to list ("production" or "test")
+    tags: tag partitions to list, a list of tags or one
+    start_date: first date partition to list (%Y-%m-%d), inclusive
+    end_date: last date partition to list (%Y-%m-%d), inclusive
+    recursive: whether to also list the files in subfolders
     """
-    s3 = get_s3_resource()
     if isinstance(file_types, str):
         file_types = [file_types]
+    if isinstance(tags, str):
+        tags = [tags]
+
+    prefixes = [root]
+    if any(value is not None for value in [env, tags, start_date, end_date]):
+        envs = (
+            [env] if env is not None else list_s3_partitions(bucket_name, root, "env")
+        )
+        prefixes = [f"{root}env={value}/" for value in envs]
+        prefixes = [
+            f"{prefix}tag={value}/"
+            for prefix in prefixes
+            for value in (
+                tags
+                if tags is not None
+                else list_s3_partitions(bucket_name, prefix, "tag")
+            )
+        ]
+        if start_date is not None or end_date is not None:
+            prefixes = [
+                f"{prefix}date={value}/"
+                for prefix in prefixes
+                for value in list_s3_partitions(bucket_name, prefix, "date")
+                if (start_date is None or value >= str(start_date))
+                and (end_date is None or value <= str(end_date))
+            ]
+
+    return [
+        files.key
+        for files in _filter_s3_objects(bucket_name, prefixes, file_types, recursive)
+    ]
+
+
+def get_s3_data_etags(bucket_name, root, file_types="*.jsonl", recursive=True):
+    """
+    Get the ETags of all files of particular file types in a S3 root location.
+    A file's ETag changes when it is overwritten.
+
+    bucket_name: The S3 bucket name
+    root: The root folder to look for files in
+    file_types: List of file types to look for, or one
+    recursive: whether to also list the files in subfolders
+    """
+    if isinstance(file_types, str):
+        file_types = [file_types]
+
+    return {
+        files.key: files.e_tag.strip('"')
+        for files in _filter_s3_objects(bucket_name, [root], file_types, recursive)
+    }
 
-    bucket = s3.Bucket(bucket_name)
 
-    s3_keys = []
-    for files in bucket.objects.filter(Prefix=root):
-        key = files.key
-        if any([fnmatch(key, pattern) for pattern in file_types]):
-            s3_keys.append(key)
+def _filter_s3_objects(bucket_name, prefixes, file_types, recursive):
+    """Lists the objects below S3 prefixes matching any of the file types."""
+    bucket = get_s3_resource().Bucket(bucket_name)
+    # without recursion, the "/" delimiter stops the listing at the prefix level
+    delimiter = {} if recursive else {"Delimiter": "/"}
 
-    return s3_keys
+    return [
+        files
+        for prefix in prefixes
+        for files in bucket.objects.filter(Prefix=prefix, **delimiter)
+        if any([fnmatch(files.key, pattern) for pattern in file_types])
+    ]
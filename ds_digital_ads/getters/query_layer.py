@@ -0,0 +1,450 @@
+"""
+Local analytical query layer over the processed tweet data.
+
+Core tables are ingested into an embedded DuckDB database (in the local inputs/
+folder) which maintains daily rollups of posts, impressions and likes per brand
+(twitter handle) and parent company, and per hashtag. Rollups are maintained
+incrementally: each version of a core table (S3 key and ETag, so a core table
+overwritten on the same day is ingested again) is only ingested once, and only
+the new tweets
+and the growth in metrics of tweets already seen are added to the rollups, so
+dashboards query small rollup tables instead of scanning history.
+
+Usage:
+
+    from ds_digital_ads.getters.query_layer import (
+        refresh_rollups,
+        get_daily_brand_metrics,
+        get_top_hashtags,
+    )
+
+    refresh_rollups()
+    get_daily_brand_metrics(start_date="2023-07-01", parent_company="lc")
+    get_top_hashtags(brand="Coral", n=10)
+"""
+import ast
+import os
+from typing import List, Optional
+
+import duckdb
+import pandas as pd
+from pandas import DataFrame
+
+from ds_digital_ads import PROJECT_DIR, BUCKET_NAME
+from ds_digital_ads.getters.data_getters import get_s3_data_etags, load_s3_data
+from ds_digital_ads.utils.data_collection_utils import PROCESSED_DATA_COLLECTION_FOLDER
+
+QUERY_DB_PATH = os.path.join(
+    PROJECT_DIR, "inputs/data_collection/ds_digital_ads.duckdb"
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS ingested_partitions (
+    partition_key VARCHAR PRIMARY KEY,
+    ingested_at TIMESTAMP
+);
+CREATE TABLE IF NOT EXISTS tweets (
+    id BIGINT PRIMARY KEY,
+    brand VARCHAR,
+    parent_company VARCHAR,
+    day DATE,
+    impressions BIGINT,
+    likes BIGINT,
+    hashtags VARCHAR[]
+);
+CREATE TABLE IF NOT EXISTS daily_brand_rollup (
+    day DATE,
+    brand VARCHAR,
+    parent_company VARCHAR,
+    posts BIGINT,
+    impressions BIGINT,
+    likes BIGINT,
+    PRIMARY KEY (day, brand)
+);
+CREATE TABLE IF NOT EXISTS daily_hashtag_rollup (
+    day DATE,
+    brand VARCHAR,
+    parent_company VARCHAR,
+    hashtag VARCHAR,
+    posts BIGINT,
+    impressions BIGINT,
+    likes BIGINT,
+    PRIMARY KEY (day, brand, hashtag)
+);
+"""
+
+_STAGE = """
+CREATE OR REPLACE TEMP TABLE staged_tweets AS
+SELECT
+    CAST(id AS BIGINT) AS id,
+    CAST(brand AS VARCHAR) AS brand,
+    CAST(parent_company AS VARCHAR) AS parent_company,
+    CAST(day AS DATE) AS day,
+    CAST(impressions AS BIGINT) AS impressions,
+    CAST(likes AS BIGINT) AS likes,
+    CAST(hashtags AS VARCHAR[]) AS hashtags
+FROM staged
+"""
+
+# rows to add to the rollups: new tweets count as one post, tweets already
+# ingested only add the growth of their (monotonic) metrics
+_DELTAS = """
+CREATE OR REPLACE TEMP TABLE deltas AS
+SELECT
+    s.id,
+    s.brand,
+    coalesce(s.parent_company, t.parent_company) AS parent_company,
+    coalesce(t.day, s.day) AS day,
+    s.hashtags,
+    greatest(s.impressions, coalesce(t.impressions, 0)) AS new_impressions,
+    greatest(s.likes, coalesce(t.likes, 0)) AS new_likes,
+    CASE WHEN t.id IS NULL THEN 1 ELSE 0 END AS posts,
+    greatest(s.impressions - coalesce(t.impressions, 0), 0) AS impressions,
+    greatest(s.likes - coalesce(t.likes, 0), 0) AS likes
+FROM staged_tweets AS s
+LEFT JOIN tweets AS t ON s.id = t.id
+WHERE t.id IS NULL OR s.impressions > t.impressions OR s.likes > t.likes
+"""
+
+_UPSERT_BRAND_ROLLUP = """
+INSERT INTO daily_brand_rollup
+SELECT day, brand, any_value(parent_company), sum(posts), sum(impressions), sum(likes)
+FROM deltas
+GROUP BY day, brand
+ON CONFLICT (day, brand) DO UPDATE SET
+    parent_company = coalesce(excluded.parent_company, parent_company),
+    posts = posts + excluded.posts,
+    impressions = impressions + excluded.impressions,
+    likes = likes + excluded.likes
+"""
+
+_UPSERT_HASHTAG_ROLLUP = """
+INSERT INTO daily_hashtag_rollup
+SELECT day, brand, any_value(parent_company), hashtag, sum(posts), sum(impressions), sum(likes)
+FROM (
+    SELECT day, brand, parent_company, unnest(list_distinct(hashtags)) AS hashtag,
+        posts, impressions, likes
+    FROM deltas
+)
+GROUP BY day, brand, hashtag
+ON CONFLICT (day, brand, hashtag) DO UPDATE SET
+    parent_company = coalesce(excluded.parent_company, parent_company),
+    posts = posts + excluded.posts,
+    impressions = impressions + excluded.impressions,
+    likes = likes + excluded.likes
+"""
+
+_UPSERT_TWEETS = """
+INSERT OR REPLACE INTO tweets
+SELECT id, brand, parent_company, day, new_impressions, new_likes, hashtags
+FROM deltas
+"""
+
+
+def get_query_connection(
+    db_path: str = QUERY_DB_PATH, read_only: bool = False
+) -> duckdb.DuckDBPyConnection:
+    """
+    Connects to the local query database, creating it and its tables if needed.
+
+    Args:
+        db_path: path to the DuckDB database file
+        read_only: whether to open the database in read only mode
+    Returns:
+        DuckDB connection.
+    """
+    if read_only:
+        return duckdb.connect(db_path, read_only=True)
+
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    connection = duckdb.connect(db_path)
+    connection.execute(_SCHEMA)
+
+    return connection
+
+
+def _parse_list(value) -> list:
+    """Parses a list column value that went through a csv (e.g. "['a', 'b']")."""
+    if isinstance(value, str):
+        return ast.literal_eval(value) if value.startswith("[") else [value]
+
+    return (
+        list(value) if value is not None and not pd.api.types.is_scalar(value) else []
+    )
+
+
+def _stage_core_table(core_df: DataFrame) -> DataFrame:
+    """
+    Reduces a core table (one row per tweet and media id) to one row per tweet
+    with the columns used by the rollups.
+
+    Args:
+        core_df: core table dataframe
+    """
+    core_df = core_df.drop_duplicates(subset="id")
+    parent_company = (
+        core_df["parent_company"]
+        if "parent_company" in core_df.columns
+        else pd.Series(None, index=core_df.index, dtype="object")
+    )
+
+    return pd.DataFrame(
+        {
+            "id": core_df["id"].astype("int64"),
+            "brand": core_df["name"].astype(str),
+            "parent_company": parent_company.astype("object").where(
+                parent_company.notna(), None
+            ),
+            "day": pd.to_datetime(core_df["created_at"], utc=True).dt.date,
+            "impressions": core_df["public_metrics_impression_count"]
+            .fillna(0)
+            .astype("int64"),
+            "likes": core_df["public_metrics_like_count"].fillna(0).astype("int64"),
+            "hashtags": core_df["hashtags"].apply(
+                lambda tags: [str(tag).lower() for tag in _parse_list(tags)]
+            ),
+        }
+    )
+
+
+def ingest_core_table(
+    connection: duckdb.DuckDBPyConnection, core_df: DataFrame, partition_key: str
+) -> bool:
+    """
+    Ingests a core table into the query database and incrementally updates the
+    rollups with it. Core tables that have already been ingested are skipped.
+
+    Args:
+        connection: DuckDB connection
+        core_df: core table dataframe
+        partition_key: unique key of the core table version (e.g. its S3 key
+            and ETag)
+    Returns:
+        Whether the core table was ingested.
+    """
+    already_ingested = connection.execute(
+        "SELECT count(*) FROM ingested_partitions WHERE partition_key = ?",
+        [partition_key],
+    ).fetchone()[0]
+    if already_ingested:
+        return False
+
+    staged = _stage_core_table(core_df)
+    connection.register("staged", staged)
+    connection.execute("BEGIN TRANSACTION")
+    try:
+        connection.execute(_STAGE)
+        connection.execute(_DELTAS)
+        connection.execute(_UPSERT_BRAND_ROLLUP)
+        connection.execute(_UPSERT_HASHTAG_ROLLUP)
+        connection.execute(_UPSERT_TWEETS)
+        connection.execute(
+            "INSERT INTO ingested_partitions VALUES (?, current_timestamp)",
+            [partition_key],
+        )
+        connection.execute("COMMIT")
+    except Exception:
+        connection.execute("ROLLBACK")
+        raise
+    finally:
+        connection.unregister("staged")
+
+    return True
+
+
+def refresh_rollups(
+    production: bool = True,
+    connection: Optional[duckdb.DuckDBPyConnection] = None,
+    bucket_name: str = BUCKET_NAME,
+) -> List[str]:
+    """
+    Ingests the processed core tables that have landed or been overwritten on
+    S3 since the last refresh, oldest first, and updates the rollups.
+
+    Args:
+        production: whether to use production core tables
+        connection: DuckDB connection (defaults to the local query database,
+            closed once the rollups are refreshed)
+        bucket_name: S3 bucket name
+    Returns:
+        List of newly ingested core table keys.
+    """
+    if connection is None:
+        with get_query_connection() as connection:
+            return refresh_rollups(production, connection, bucket_name)
+
+    ingested = {
+        row[0]
+        for row in connection.execute(
+            "SELECT partition_key FROM ingested_partitions"
+        ).fetchall()
+    }
+    # core tables sit directly in the processed folder, so its subfolders
+    # (images, indexes, snapshots...) are not listed
+    core_table_etags = get_s3_data_etags(
+        bucket_name,
+        PROCESSED_DATA_COLLECTION_FOLDER,
+        file_types=[
+            f"*core_table_{str(production).lower()}_*.csv",
+            f"*core_table_{str(production).lower()}_*.parquet",
+        ],
+        recursive=False,
+    )
+
+    new_core_tables = []
+    for core_table, etag in sorted(core_table_etags.items()):
+        partition_key = f"{core_table}#{etag}"
+        if partition_key in ingested:
+            continue
+        print(f"ingesting {core_table}...")
+        if ingest_core_table(
+            connection, load_s3_data(bucket_name, core_table), partition_key
+        ):
+            new_core_tables.append(core_table)
+
+    return new_core_tables
+
+
+def query(
+    sql: str,
+    parameters: Optional[list] = None,
+    connection: Optional[duckdb.DuckDBPyConnection] = None,
+) -> DataFrame:
+    """
+    Runs a SQL query against the query database.
+
+    Args:
+        sql: SQL query (tables: tweets, daily_brand_rollup, daily_hashtag_rollup)
+        parameters: query parameters for "?" placeholders
+        connection: DuckDB connection (defaults to the local query database,
+            closed once the query has run)
+    Returns:
+        Dataframe with the query results.
+    """
+    if connection is None:
+        with get_query_connection() as connection:
+            return query(sql, parameters, connection)
+
+    return connection.execute(sql, parameters or []).df()
+
+
+def _filters(
+    start_date: Optional[str],
+    end_date: Optional[str],
+    brand: Optional[str],
+    parent_company: Optional[str],
+) -> tuple:
+    """Builds a SQL WHERE clause and its parameters for the rollup getters."""
+    conditions, parameters = ["TRUE"], []
+    for condition, value in [
+        ("day >= CAST(? AS DATE)", start_date),
+        ("day <= CAST(? AS DATE)", end_date),
+        ("brand = ?", brand),
+        ("parent_company = ?", parent_company),
+    ]:
+        if value is not None:
+            conditions.append(condition)
+            parameters.append(value)
+
+    return " AND ".join(conditions), parameters
+
+
+def get_daily_brand_metrics(
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    brand: Optional[str] = None,
+    parent_company: Optional[str] = None,
+    connection: Optional[duckdb.DuckDBPyConnection] = None,
+) -> DataFrame:
+    """
+    Gets daily posts, impressions and likes per brand.
+
+    Args:
+        start_date: first day to include (YYYY-MM-DD)
+        end_date: last day to include (YYYY-MM-DD)
+        brand: only include this brand (twitter handle)
+        parent_company: only include brands of this parent company
+        connection: DuckDB connection (defaults to the local query database)
+    """
+    where, parameters = _filters(start_date, end_date, brand, parent_company)
+
+    return query(
+        f"""
+        SELECT day, brand, parent_company, posts, impressions, likes
+        FROM daily_brand_rollup
+        WHERE {where}
+        ORDER BY day, brand
+        """,
+        parameters,
+        connection,
+    )
+
+
+def get_daily_parent_company_metrics(
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    parent_company: Optional[str] = None,
+    connection: Optional[duckdb.DuckDBPyConnection] = None,
+) -> DataFrame:
+    """
+    Gets daily posts, impressions and likes per parent company.
+
+    Args:
+        start_date: first day to include (YYYY-MM-DD)
+        end_date: last day to include (YYYY-MM-DD)
+        parent_company: only include this parent company
+        connection: DuckDB connection (defaults to the local query database)
+    """
+    where, parameters = _filters(start_date, end_date, None, parent_company)
+
+    return query(
+        f"""
+        SELECT day, parent_company, CAST(sum(posts) AS BIGINT) AS posts,
+            CAST(sum(impressions) AS BIGINT) AS impressions,
+            CAST(sum(likes) AS BIGINT) AS likes
+        FROM daily_brand_rollup
+        WHERE {where}
+        GROUP BY day, parent_company
+        ORDER BY day, parent_company
+        """,
+        parameters,
+        connection,
+    )
+
+
+def get_top_hashtags(
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    brand: Optional[str] = None,
+    parent_company: Optional[str] = None,
+    n: int = 20,
+    connection: Optional[duckdb.DuckDBPyConnection] = None,
+) -> DataFrame:
+    """
+    Gets the most used hashtags, with the impressions and likes of the tweets
+    using them.
+
+    Args:
+        start_date: first day to include (YYYY-MM-DD)
+        end_date: last day to include (YYYY-MM-DD)
+        brand: only include this brand (twitter handle)
+        parent_company: only include brands of this parent company
+        n: number of hashtags to return
+        connection: DuckDB connection (defaults to the local query database)
+    """
+    where, parameters = _filters(start_date, end_date, brand, parent_company)
+
+    return query(
+        f"""
+        SELECT hashtag, CAST(sum(posts) AS BIGINT) AS posts,
+            CAST(sum(impressions) AS BIGINT) AS impressions,
+            CAST(sum(likes) AS BIGINT) AS likes
+        FROM daily_hashtag_rollup
+        WHERE {where}
+        GROUP BY hashtag
+        ORDER BY posts DESC, impressions DESC
+        LIMIT ?
+        """,
+        parameters + [n],
+        connection,
+    )
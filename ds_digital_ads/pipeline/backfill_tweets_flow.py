@@ -0,0 +1,273 @@
+"""
+Flow to backfill Twitter data for one or more handles over the last 7 days
+using the recent search endpoint.
+
+Instead of one long serial pagination over the whole window, the window is
+split into contiguous time slices (start_time/end_time) which are collected in
+parallel within the rate budget of the bearer token pool. Slices are merged
+into one deduplicated raw file per handle, and max_tweet_id.json is updated
+with the newest tweet collected so the regular collection flow carries on from
+there.
+
+if you want to test the flow:
+python ds_digital_ads/pipeline/backfill_tweets_flow.py run --handles betway
+
+if you want to run the flow in production:
+python ds_digital_ads/pipeline/backfill_tweets_flow.py run --handles betway --production True
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import partial
+import os
+from typing import List
+
+from dotenv import load_dotenv
+
+from ds_digital_ads.utils.data_collection_utils import (
+    RAW_DATA_COLLECTION_FOLDER,
+    query_parameters_twitter,
+)
+from ds_digital_ads.utils.twitter_api_utils import TokenPool, parse_bearer_tokens
+from ds_digital_ads.pipeline.collect_tweets_flow import (
+    collect_all_pages,
+    empty_data_dict,
+    get_max_ids_json,
+    record_collection_history,
+    save_raw_data,
+    update_max_ids_json,
+)
+from ds_digital_ads.utils.twitter_models import Meta, SearchResponse
+from ds_digital_ads import BUCKET_NAME
+
+from metaflow import FlowSpec, step, Parameter
+
+load_dotenv()
+
+# start_time/end_time format accepted by the recent search endpoint
+TWITTER_QUERY_TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+def backfill_window(days: int) -> tuple:
+    """
+    Returns the start and end of the window to backfill, ending now. end_time
+    must be a few seconds in the past and start_time within the last 7 days when
+    the (later) requests are made, so some margin is left on both ends.
+
+    Args:
+        days: number of days to backfill (at most 7)
+    Returns:
+        Tuple with the start and end of the window.
+    """
+    now = datetime.utcnow()
+    window_end = now - timedelta(minutes=1)
+    window_start = max(now - timedelta(days=days), now - timedelta(days=7, minutes=-30))
+
+    return window_start, window_end
+
+
+def time_slices(start: datetime, end: datetime, n_slices: int) -> List[tuple]:
+    """
+    Splits a time window into contiguous slices of equal length, newest first.
+    The end of each slice is the start of the next newer one, so the slices
+    cover the whole window without gaps or overlaps (start_time is inclusive
+    and end_time is exclusive in the recent search endpoint).
+
+    Args:
+        start: start of the window
+        end: end of the window
+        n_slices: number of slices
+    Returns:
+        List of (start_time, end_time) tuples formatted for the endpoint.
+    """
+    edges = [start + (end - start) * i / n_slices for i in range(n_slices)] + [end]
+    edges = [edge.strftime(TWITTER_QUERY_TIME_FORMAT) for edge in edges]
+
+    return [(edges[i], edges[i + 1]) for i in reversed(range(n_slices))]
+
+
+def merge_twitter_data(data_list: List[SearchResponse]) -> SearchResponse:
+    """
+    Merges Twitter style endpoint outputs into one, dropping duplicated
+    tweets, users, places and media (first occurrence is kept).
+
+    Args:
+        data_list: list of Twitter style endpoint outputs
+    Returns:
+        Merged and deduplicated output.
+    """
+    merged = empty_data_dict()
+    seen = {"data": set(), "users": set(), "places": set(), "media": set()}
+    id_keys = {"data": "id", "users": "id", "places": "id", "media": "media_key"}
+
+    for data in data_list:
+        for key in ["data", "users", "places", "media"]:
+            items = data.data if key == "data" else getattr(data.includes, key)
+            merged_items = (
+                merged.data if key == "data" else getattr(merged.includes, key)
+            )
+            for item in items:
+                item_id = getattr(item, id_keys[key])
+                if item_id not in seen[key]:
+                    seen[key].add(item_id)
+                    merged_items.append(item)
+
+    return merged
+
+
+def newest_tweet_response(data: SearchResponse) -> SearchResponse:
+    """
+    Builds a json response whose metadata points at the newest tweet in the
+    data, to be used with update_max_ids_json.
+
+    Args:
+        data: Twitter style endpoint output with at least one tweet
+    """
+    newest_id = max((tweet.id for tweet in data.data), key=int)
+
+    return SearchResponse(data=data.data, meta=Meta(newest_id=newest_id))
+
+
+class BackfillTweetsFlow(FlowSpec):
+    production = Parameter("production", help="Run in production?", default=False)
+    handles = Parameter(
+        "handles",
+        help="Comma separated Twitter handles to backfill (defaults to all handles)",
+        default="",
+    )
+    days = Parameter(
+        "days", help="Number of days to backfill (at most 7)", default=7, type=int
+    )
+    n_slices = Parameter(
+        "n_slices", help="Number of time slices per handle", default=14, type=int
+    )
+    max_workers = Parameter(
+        "max_workers",
+        help="Number of slices collected in parallel",
+        default=4,
+        type=int,
+    )
+    bearer_token = Parameter(
+        "bearer_token",
+        help="Twitter bearer token",
+        default=os.environ.get("BEARER_TOKEN"),
+    )
+    bearer_tokens = Parameter(
+        "bearer_tokens",
+        help="Comma separated Twitter bearer tokens to pool requests across",
+        default=os.environ.get("BEARER_TOKENS"),
+    )
+
+    @step
+    def start(self):
+        """
+        Initialises bearer tokens, max ids and rules to backfill.
+        """
+        from ds_digital_ads.utils.data_collection_utils import (
+            digital_ads_ruleset_twitter,
+        )
+
+        self.bearer_token_list = parse_bearer_tokens(
+            self.bearer_token, self.bearer_tokens
+        )
+        if not self.bearer_token_list:
+            print(
+                "BEARER_TOKEN or BEARER_TOKENS environment variable not set. Please set it and try again."
+            )
+
+        self.date_time_collection_start = datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
+        self.max_ids_json = get_max_ids_json(BUCKET_NAME, RAW_DATA_COLLECTION_FOLDER)
+        self.query_parameters_twitter = dict(query_parameters_twitter)
+        self.query_parameters_twitter["max_results"] = 100 if self.production else 10
+
+        handles = [handle.strip().lower() for handle in self.handles.split(",")]
+        self.digital_ads_ruleset_twitter = [
+            rule
+            for rule in digital_ads_ruleset_twitter
+            if not self.handles or rule["tag"][: -len("_promotions")].lower() in handles
+        ]
+        self.digital_ads_ruleset_twitter = (
+            self.digital_ads_ruleset_twitter
+            if self.production
+            else self.digital_ads_ruleset_twitter[:1]
+        )
+
+        self.next(self.backfill_tweets)
+
+    @step
+    def backfill_tweets(self):
+        """
+        Collects the time slices of every rule in parallel, merges them and stores
+        them and the updated max tweet ids to s3.
+        """
+        token_pool = TokenPool(self.bearer_token_list)
+
+        def collect_slice(query: str, time_slice: tuple) -> SearchResponse:
+            parameters = dict(self.query_parameters_twitter)
+            parameters["query"] = query
+            parameters["start_time"], parameters["end_time"] = time_slice
+            data, _ = collect_all_pages(token_pool, parameters)
+            return data
+
+        for rule in self.digital_ads_ruleset_twitter:
+            query_tag = rule["tag"]
+            print(f"backfilling tweets for {query_tag} in {self.n_slices} slices...")
+
+            # the window is computed per rule, as earlier rules can take long
+            # enough for a window computed up front to fall outside the last 7 days
+            window_start, window_end = backfill_window(self.days)
+            window_hours = (window_end - window_start).total_seconds() / 3600
+
+            # slices are returned in order (newest first) and any failed slice
+            # raises here, so the merged output is contiguous
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                slices_data = list(
+                    executor.map(
+                        partial(collect_slice, rule["value"]),
+                        time_slices(window_start, window_end, self.n_slices),
+                    )
+                )
+            data = merge_twitter_data(slices_data)
+            print(f"{len(data.data)} tweets collected for {query_tag}")
+
+            if data.data:
+                json_response = newest_tweet_response(data)
+                previous_newest_id = self.max_ids_json.get(query_tag, {}).get(
+                    "newest_id"
+                )
+                if previous_newest_id is None or int(
+                    json_response.meta.newest_id
+                ) > int(previous_newest_id):
+                    self.max_ids_json.setdefault(query_tag, dict())
+                    update_max_ids_json(
+                        json_response,
+                        self.max_ids_json,
+                        query_tag,
+                        self.date_time_collection_start,
+                    )
+            record_collection_history(
+                self.max_ids_json,
+                query_tag,
+                len(data.data),
+                window_hours,
+                self.date_time_collection_start,
+            )
+
+            print(f"saving tweets for {query_tag}...")
+            save_raw_data(
+                data,
+                self.max_ids_json,
+                query_tag,
+                self.date_time_collection_start,
+                self.production,
+            )
+
+        self.next(self.end)
+
+    @step
+    def end(self):
+        """Ends the flow"""
+        pass
+
+
+if __name__ == "__main__":
+    BackfillTweetsFlow()
@@ -0,0 +1,260 @@
+"""
+Flow to collect the Google ad creatives shown in the UK by the advertisers in
+gambling_advertisers_uk, using the Google Ads Transparency Center search endpoint.
+
+Advertisers are collected concurrently and every request shares one rate
+limiter, so the collection stays within `requests_per_minute` however many
+workers are used. Like the tweet collection, it is incremental: the latest
+"last shown" date collected per advertiser is kept in max_last_shown.json and
+only creatives shown since then are collected. Each advertiser's creatives are
+saved to the partitioned raw layout (env=/tag=/date=, the tag being the parent
+company) as soon as they are collected.
+
+if you want to test the flow (first advertiser, first page of results):
+python ds_digital_ads/pipeline/collect_google_ads_flow.py run
+
+if you want to test the flow against a local stand-in of the endpoint (see
+google_ads_stand_in.py):
+python ds_digital_ads/pipeline/google_ads_stand_in.py
+python ds_digital_ads/pipeline/collect_google_ads_flow.py run --endpoint_url http://localhost:8000
+
+if you want to run the flow in production:
+python ds_digital_ads/pipeline/collect_google_ads_flow.py run --production True
+"""
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from typing import List
+
+from ds_digital_ads.utils.data_collection_utils import (
+    GOOGLE_ADS_STATE_FILE,
+    GOOGLE_ADS_TRANSPARENCY_URL,
+    GOOGLE_RAW_DATA_COLLECTION_FOLDER,
+    google_advertiser_ids,
+    raw_data_folder,
+)
+from ds_digital_ads.utils.google_ads_api_utils import (
+    RateLimiter,
+    connect_to_endpoint,
+    parse_creative,
+    search_creatives_payload,
+)
+from ds_digital_ads.pipeline.collect_tweets_flow import get_max_ids_json
+from ds_digital_ads.getters.data_getters import dictionary_to_s3
+from ds_digital_ads import BUCKET_NAME
+
+from metaflow import FlowSpec, step, Parameter
+
+
+def collect_advertiser(
+    rate_limiter: RateLimiter,
+    advertiser_id: str,
+    max_last_shown: int = 0,
+    max_pages: int = 50,
+    endpoint_url: str = GOOGLE_ADS_TRANSPARENCY_URL,
+) -> List[dict]:
+    """
+    Collects an advertiser's creatives last shown after max_last_shown, following
+    the page tokens. Results are ordered by last shown date (newest first), so
+    pagination stops at the first page containing creatives already collected.
+
+    Args:
+        rate_limiter: rate limiter shared by all requests
+        advertiser_id: Google advertiser id (AR...)
+        max_last_shown: latest last shown timestamp collected so far
+        max_pages: maximum number of pages to request
+        endpoint_url: url of the endpoint
+    Returns:
+        List of deduplicated creative records.
+    """
+    creatives = {}
+    page_token = None
+    for _ in range(max_pages):
+        json_response = connect_to_endpoint(
+            rate_limiter,
+            search_creatives_payload(advertiser_id, page_token=page_token),
+            endpoint_url=endpoint_url,
+        )
+        page = [parse_creative(creative) for creative in json_response.get("1", [])]
+        new_creatives = [
+            creative
+            for creative in page
+            if creative["last_shown_timestamp"] > max_last_shown
+        ]
+        for creative in new_creatives:
+            creatives.setdefault(creative["creative_id"], creative)
+
+        page_token = json_response.get("2")
+        if not page_token or len(new_creatives) < len(page):
+            break
+
+    return list(creatives.values())
+
+
+def update_max_last_shown_json(
+    max_last_shown_json: dict,
+    parent_company: str,
+    advertiser_id: str,
+    creatives: List[dict],
+    date_time_collection_start: str,
+):
+    """
+    Updates the dictionary with the latest last shown timestamp collected for an
+    advertiser, the number of creatives collected and the collection date time.
+
+    Args:
+        max_last_shown_json: dictionary with latest last shown timestamps collected
+        parent_company: parent company of the advertiser
+        advertiser_id: Google advertiser id
+        creatives: creatives collected
+        date_time_collection_start: date time we started data collection
+    """
+    state = max_last_shown_json.setdefault(parent_company, dict())
+    state["advertiser_id"] = advertiser_id
+    state["last_shown_timestamp"] = max(
+        [state.get("last_shown_timestamp", 0)]
+        + [creative["last_shown_timestamp"] for creative in creatives]
+    )
+    state["n_creatives"] = len(creatives)
+    state["collection_datetime"] = date_time_collection_start
+
+
+class CollectGoogleAdsFlow(FlowSpec):
+    production = Parameter("production", help="Run in production?", default=False)
+    advertisers = Parameter(
+        "advertisers",
+        help="Comma separated parent companies to collect, all if not set",
+        default="",
+    )
+    requests_per_minute = Parameter(
+        "requests_per_minute",
+        help="Request budget per minute shared by all workers",
+        default=30,
+        type=float,
+    )
+    max_workers = Parameter(
+        "max_workers",
+        help="Number of advertisers collected concurrently",
+        default=4,
+        type=int,
+    )
+    max_pages = Parameter(
+        "max_pages",
+        help="Maximum number of pages of creatives per advertiser",
+        default=50,
+        type=int,
+    )
+    endpoint_url = Parameter(
+        "endpoint_url",
+        help="Search endpoint url, e.g. a local stand-in for testing",
+        default=GOOGLE_ADS_TRANSPARENCY_URL,
+    )
+
+    @step
+    def start(self):
+        """
+        Initialises advertisers, max last shown timestamps and collection start date.
+        """
+        self.date_time_collection_start = datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
+        self.max_last_shown_json = get_max_ids_json(
+            BUCKET_NAME, GOOGLE_RAW_DATA_COLLECTION_FOLDER, GOOGLE_ADS_STATE_FILE
+        )
+
+        parent_companies = [
+            parent_company.strip().lower()
+            for parent_company in self.advertisers.split(",")
+        ]
+        self.google_advertiser_ids = {
+            parent_company: advertiser_id
+            for parent_company, advertiser_id in google_advertiser_ids.items()
+            if not self.advertisers or parent_company.lower() in parent_companies
+        }
+        if not self.production:
+            self.google_advertiser_ids = dict(
+                list(self.google_advertiser_ids.items())[:1]
+            )
+        self.pages = self.max_pages if self.production else 1
+
+        self.next(self.collect_ads)
+
+    @step
+    def collect_ads(self):
+        """
+        Collects the creatives of every advertiser concurrently and stores each
+        advertiser's creatives and the updated max last shown timestamps to s3
+        as soon as they are collected.
+        """
+        rate_limiter = RateLimiter(self.requests_per_minute)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {
+                executor.submit(
+                    collect_advertiser,
+                    rate_limiter,
+                    advertiser_id,
+                    self.max_last_shown_json.get(parent_company, {}).get(
+                        "last_shown_timestamp", 0
+                    ),
+                    self.pages,
+                    self.endpoint_url,
+                ): parent_company
+                for parent_company, advertiser_id in self.google_advertiser_ids.items()
+            }
+            self.failed_advertisers = []
+            for future in as_completed(futures):
+                parent_company = futures[future]
+                advertiser_id = self.google_advertiser_ids[parent_company]
+                try:
+                    creatives = future.result()
+                except Exception as e:
+                    # one failed advertiser must not discard the others' results
+                    print(
+                        f"Collection failed for {parent_company} "
+                        f"({type(e).__name__}: {e}), it will be retried next run"
+                    )
+                    self.failed_advertisers.append(parent_company)
+                    continue
+                print(f"{len(creatives)} creatives collected for {parent_company}")
+
+                filename = f"ads_transparency_{parent_company}_{self.date_time_collection_start}_production_{str(self.production).lower()}.json"
+                dictionary_to_s3(
+                    {
+                        "parent_company": parent_company,
+                        "advertiser_id": advertiser_id,
+                        "creatives": creatives,
+                    },
+                    BUCKET_NAME,
+                    raw_data_folder(
+                        parent_company,
+                        self.date_time_collection_start,
+                        self.production,
+                        root=GOOGLE_RAW_DATA_COLLECTION_FOLDER,
+                    ),
+                    filename,
+                )
+                update_max_last_shown_json(
+                    self.max_last_shown_json,
+                    parent_company,
+                    advertiser_id,
+                    creatives,
+                    self.date_time_collection_start,
+                )
+                dictionary_to_s3(
+                    self.max_last_shown_json,
+                    BUCKET_NAME,
+                    GOOGLE_RAW_DATA_COLLECTION_FOLDER,
+                    GOOGLE_ADS_STATE_FILE,
+                )
+
+        if self.failed_advertisers:
+            print(f"failed advertisers: {', '.join(self.failed_advertisers)}")
+
+        self.next(self.end)
+
+    @step
+    def end(self):
+        """Ends the flow"""
+        pass
+
+
+if __name__ == "__main__":
+    CollectGoogleAdsFlow()
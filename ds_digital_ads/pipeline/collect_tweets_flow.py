@@ -11,23 +11,32 @@ python ds_digital_ads/pipeline/collect_tweets_flow.py run
 if you want to run the flow in production:
 python ds_digital_ads/pipeline/collect_tweets_flow.py run --production True
 
+Requests are spread across every bearer token in BEARER_TOKEN and BEARER_TOKENS
+(comma separated) and rules are collected concurrently, one at a time per token,
+so throughput scales with the number of app credentials.
+
 """
-import requests
-import time
-import random
 import boto3
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from copy import deepcopy
 from datetime import datetime, timedelta
-import pandas as pd
 import os
 from dotenv import load_dotenv
 
 from ds_digital_ads.utils.data_collection_utils import (
     RAW_DATA_COLLECTION_FOLDER,
-    ENDPOINT_URL,
     query_parameters_twitter,
+    raw_data_folder,
+)
+from ds_digital_ads.utils.twitter_api_utils import (
+    TokenPool,
+    connect_to_endpoint,
+    parse_bearer_tokens,
 )
+from ds_digital_ads.utils.twitter_models import SearchResponse, encode_response
 
 from ds_digital_ads.getters.data_getters import (
+    bytes_to_s3,
     dictionary_to_s3,
     read_json_from_s3,
     read_json_from_local_path,
@@ -38,60 +47,16 @@ from metaflow import FlowSpec, step, Parameter
 
 load_dotenv()
 
-
-def request_headers(bearer_token: str) -> dict:
-    """
-    Set up the request headers.
-    Returns a dictionary summarising the bearer token authentication details.
-
-    Args:
-        bearer_token: bearer token credentials
-    """
-    return {"Authorization": "Bearer {}".format(bearer_token)}
+# number of past collections kept per tag in max_tweet_id.json
+MAX_COLLECTION_HISTORY = 30
 
 
-def connect_to_endpoint(headers: dict, parameters: dict) -> dict:
+def process_twitter_data(
+    json_response: SearchResponse, data: SearchResponse
+) -> SearchResponse:
     """
-    Connects to the endpoint and requests data.
-    Returns a json with Twitter data if a 200 status code is yielded.
-    Programme stops if there is a problem with the request and sleeps
-    if there is a temporary problem accessing the endpoint.
-
-    Args:
-        headers: request headers
-        parameters: query parameters
-    Returns:
-        Dictionary with json response from API call.
-    """
-
-    response = requests.request(
-        "GET", url=ENDPOINT_URL, headers=headers, params=parameters
-    )
-    response_status_code = response.status_code
-    if response_status_code != 200:
-        if response_status_code >= 400 and response_status_code < 500:
-            raise Exception(
-                "Cannot get data, the program will stop!\nHTTP {}: {}".format(
-                    response_status_code, response.text
-                )
-            )
-
-        sleep_seconds = random.randint(5, 60)
-        print(
-            "Cannot get data, your program will sleep for {} seconds...\nHTTP {}: {}".format(
-                sleep_seconds, response_status_code, response.text
-            )
-        )
-        time.sleep(sleep_seconds)
-        return connect_to_endpoint(headers, parameters)
-    # sleeping 5 seconds not to surpass rate limit
-    time.sleep(5)
-    return response.json()
-
-
-def process_twitter_data(json_response: dict, data: list) -> list:
-    """
-    Processes new Twitter data.
+    Processes new Twitter data. Users, places and media already included in
+    a previous page are not appended again.
 
     Args:
         json_response: new data collected from the endpoint
@@ -100,42 +65,62 @@ def process_twitter_data(json_response: dict, data: list) -> list:
     Returns:
         Returns updated data.
     """
-    if "data" in json_response.keys():
-        data["data"] = data["data"] + json_response["data"]
-
-        if "users" in json_response["includes"].keys():
-            data["includes"]["users"] = (
-                data["includes"]["users"] + json_response["includes"]["users"]
+    if json_response.data:
+        data.data.extend(json_response.data)
+
+        for include, id_key in [
+            ("users", "id"),
+            ("places", "id"),
+            ("media", "media_key"),
+        ]:
+            items = getattr(data.includes, include)
+            seen_ids = {getattr(item, id_key) for item in items}
+            items.extend(
+                item
+                for item in getattr(json_response.includes, include)
+                if getattr(item, id_key) not in seen_ids
             )
 
-        if "places" in json_response["includes"].keys():
-            data["includes"]["places"] = (
-                data["includes"]["places"] + json_response["includes"]["places"]
-            )
+    return data
 
-        if "media" in json_response["includes"].keys():
-            data["includes"]["media"] = (
-                data["includes"]["media"] + json_response["includes"]["media"]
-            )
 
-    return data
+def empty_data_dict() -> SearchResponse:
+    """
+    Creates and returns an empty Twitter style endpoint output.
+    """
+    return SearchResponse()
 
 
-def empty_data_dict() -> dict:
+def collect_all_pages(token_pool: TokenPool, query_parameters: dict) -> tuple:
     """
-    Creates and returns an empty Twitter style endpoint dictionary output.
+    Collects every page of results for a query, following the next_token
+    pagination, and returns them as one Twitter style endpoint output.
+
+    Args:
+        token_pool: pool of bearer tokens
+        query_parameters: query parameters (not modified)
+    Returns:
+        Tuple with all data collected and the json response of the first page
+        (which contains the newest possible tweets).
     """
-    data = dict()
-    data["data"] = []
-    data["includes"] = dict()
-    data["includes"]["users"] = []
-    data["includes"]["places"] = []
-    data["includes"]["media"] = []
+    parameters = dict(query_parameters)
+    data = empty_data_dict()
 
-    return data
+    json_response = connect_to_endpoint(token_pool, parameters)
+    first_response = json_response
+    data = process_twitter_data(json_response, data)
+
+    while json_response.meta.next_token is not None:
+        parameters["next_token"] = json_response.meta.next_token
+        json_response = connect_to_endpoint(token_pool, parameters)
+        data = process_twitter_data(json_response, data)
+
+    return data, first_response
 
 
-def get_max_ids_json(s3_bucket: str, folder: str) -> dict:
+def get_max_ids_json(
+    s3_bucket: str, folder: str, file_name: str = "max_tweet_id.json"
+) -> dict:
     """
     Gets max_tweet_id.json file if it exists. Otherwise, it creates one.
     This file contains information about the latest tweet ID collected for a specific
@@ -143,12 +128,13 @@ def get_max_ids_json(s3_bucket: str, folder: str) -> dict:
     Arg:
         s3_bucket: name of S3 bucket where file is stored (if None, then search in local inputs/folder)
         folder: folder where file is stored (within the S3 bucket or the local inputs/ folder)
+        file_name: name of the file (other collections keep their own state file)
     Returns:
         Dictionary with latest tweet IDs collected so far.
     """
     if s3_bucket is None:  # search for file in local inputs folder
         local_path = os.path.join(PROJECT_DIR / "inputs/", folder)
-        file_path = os.path.join(local_path, "max_tweet_id.json")
+        file_path = os.path.join(local_path, file_name)
         if os.path.exists(file_path):
             max_ids_json = read_json_from_local_path(file_path)
         else:
@@ -159,10 +145,11 @@ def get_max_ids_json(s3_bucket: str, folder: str) -> dict:
         bucket = s3_resource.Bucket(s3_bucket)
 
         # Check if we already have a json with information about previous data collections
+        # (only listing keys starting with the file path, not the whole raw folder)
+        file_path = os.path.join(folder, file_name)
         data_collection_json = [
-            objects.key for objects in bucket.objects.filter(Prefix=folder)
+            objects.key for objects in bucket.objects.filter(Prefix=file_path)
         ]
-        file_path = os.path.join(folder, "max_tweet_id.json")
         if file_path in data_collection_json:
             max_ids_json = read_json_from_s3(s3_bucket, file_path=file_path)
         else:  # if not, we create one
@@ -172,7 +159,7 @@ def get_max_ids_json(s3_bucket: str, folder: str) -> dict:
 
 
 def update_max_ids_json(
-    json_response: dict,
+    json_response: SearchResponse,
     max_ids_json: dict,
     query_tag: str,
     date_time_collection_start: datetime,
@@ -190,18 +177,162 @@ def update_max_ids_json(
         date_time_collection_start: date time we started data collection
     """
     # newest id info
-    newest_id = json_response["meta"]["newest_id"]
+    newest_id = json_response.meta.newest_id
     max_ids_json[query_tag]["newest_id"] = newest_id
-    data_df = pd.DataFrame(json_response["data"])
 
     # newest id datetime created
-    max_id_datetime = data_df[data_df["id"] == newest_id]["created_at"].iloc[0]
+    max_id_datetime = next(
+        tweet.created_at for tweet in json_response.data if tweet.id == newest_id
+    )
     max_ids_json[query_tag]["created_at"] = max_id_datetime
 
     # data collection date time
     max_ids_json[query_tag]["collection_datetime"] = date_time_collection_start
 
 
+def record_collection_history(
+    max_ids_json: dict,
+    query_tag: str,
+    n_tweets: int,
+    window_hours: float,
+    date_time_collection_start: str,
+):
+    """
+    Appends a collection to the history kept in max_tweet_id.json for a query tag,
+    i.e. how many new tweets were collected and over how many hours they were
+    posted. The history is used to learn each handle's posting rate and only the
+    latest MAX_COLLECTION_HISTORY collections are kept.
+
+    Args:
+        max_ids_json: dictionary with latest tweet IDs collected
+        query_tag: tag for query we are collecting data on
+        n_tweets: number of new tweets collected
+        window_hours: number of hours covered by the collection
+        date_time_collection_start: date time we started data collection
+    """
+    history = max_ids_json.setdefault(query_tag, dict()).setdefault("history", [])
+    history.append(
+        {
+            "collection_datetime": date_time_collection_start,
+            "n_tweets": n_tweets,
+            "window_hours": round(window_hours, 3),
+        }
+    )
+    del history[:-MAX_COLLECTION_HISTORY]
+
+
+def save_raw_data(
+    data: SearchResponse,
+    max_ids_json: dict,
+    query_tag: str,
+    date_time_collection_start: str,
+    production: bool,
+):
+    """
+    Saves the data collected for a query tag to its raw data partition, then the
+    updated max_tweet_id.json.
+
+    Args:
+        data: Twitter style endpoint output collected for the query tag
+        max_ids_json: dictionary with latest tweet IDs collected
+        query_tag: tag for query we collected data on
+        date_time_collection_start: date time we started data collection
+        production: whether the data was collected in production
+    """
+    filename = f"recent_search_{query_tag}_{date_time_collection_start}_production_{str(production).lower()}.json"
+    bytes_to_s3(
+        encode_response(data),
+        BUCKET_NAME,
+        raw_data_folder(query_tag, date_time_collection_start, production),
+        filename,
+    )
+    dictionary_to_s3(
+        max_ids_json,
+        BUCKET_NAME,
+        RAW_DATA_COLLECTION_FOLDER,
+        "max_tweet_id.json",
+    )
+
+
+def collect_rule(
+    token_pool: TokenPool,
+    query_parameters: dict,
+    rule: dict,
+    max_ids_json: dict,
+    date_time_collection_start: str,
+) -> SearchResponse:
+    """
+    Collects new tweets for a rule, only asking for tweets newer than the latest
+    tweet ID collected if it was posted in the past 7 days, and updates the
+    max tweet ids and collection history for the rule's tag.
+
+    Args:
+        token_pool: pool of bearer tokens
+        query_parameters: query parameters (not modified)
+        rule: rule with the query "value" and its "tag"
+        max_ids_json: dictionary with latest tweet IDs collected
+        date_time_collection_start: date time we started data collection
+    Returns:
+        Twitter style endpoint output with all new data collected.
+    """
+    parameters = dict(query_parameters)
+    parameters["query"] = rule["value"]
+    query_tag = rule["tag"]
+    collection_start = datetime.strptime(
+        date_time_collection_start, "%Y_%m_%d_%H_%M_%S"
+    )
+    window_hours = 7 * 24
+
+    # Checking if we have info about the latest tweet ID collected for the query_tag
+    if (query_tag in max_ids_json.keys()) and (
+        "newest_id" in max_ids_json[query_tag].keys()
+    ):
+        # We only use the since_id param if that latest tweet ID collected was posted in the past 7 days
+        created_at = datetime.strptime(
+            max_ids_json[query_tag]["created_at"], "%Y-%m-%dT%H:%M:%S.000Z"
+        )
+        if created_at + timedelta(7) > datetime.now():
+            parameters["since_id"] = max_ids_json[query_tag]["newest_id"]
+            # collections that found no new tweets are only recorded in the history
+            history = max_ids_json[query_tag].get("history")
+            previous_collection = datetime.strptime(
+                history[-1]["collection_datetime"]
+                if history
+                else max_ids_json[query_tag]["collection_datetime"],
+                "%Y_%m_%d_%H_%M_%S",
+            )
+            window_hours = min(
+                (collection_start - previous_collection).total_seconds() / 3600,
+                window_hours,
+            )
+    else:
+        # keep the collection history of tags that have no newest id yet
+        max_ids_json.setdefault(query_tag, dict())
+
+    # Collecting and processing data
+    data, json_response = collect_all_pages(token_pool, parameters)
+
+    # updating json with info about max tweet id collected, to be used next time we collect data
+    # note that first page of tweets contains the newest possible tweets
+    if json_response.meta.newest_id is not None:
+        # Updating json with max tweet id collected
+        update_max_ids_json(
+            json_response,
+            max_ids_json,
+            query_tag,
+            date_time_collection_start,
+        )
+    record_collection_history(
+        max_ids_json,
+        query_tag,
+        len(data.data),
+        window_hours,
+        date_time_collection_start,
+    )
+
+    return data
+
+
 class CollectTweetsFlow(FlowSpec):
     production = Parameter("production", help="Run in production?", default=False)
     bearer_token = Parameter(
@@ -209,21 +340,27 @@ class CollectTweetsFlow(FlowSpec):
         help="Twitter bearer token",
         default=os.environ.get("BEARER_TOKEN"),
     )
+    bearer_tokens = Parameter(
+        "bearer_tokens",
+        help="Comma separated Twitter bearer tokens to pool requests across",
+        default=os.environ.get("BEARER_TOKENS"),
+    )
 
     @step
     def start(self):
         """
-        Initialises headers, max ids and collection start date.
+        Initialises bearer tokens, max ids and collection start date.
         """
         from ds_digital_ads.utils.data_collection_utils import (
             digital_ads_ruleset_twitter,
         )
 
-        if self.bearer_token:
-            self.headers = request_headers(self.bearer_token)
-        else:
+        self.bearer_token_list = parse_bearer_tokens(
+            self.bearer_token, self.bearer_tokens
+        )
+        if not self.bearer_token_list:
             print(
-                "BEARER_TOKEN environment variable not set. Please set it and try again."
+                "BEARER_TOKEN or BEARER_TOKENS environment variable not set. Please set it and try again."
             )
 
         self.date_time_collection_start = datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
@@ -246,75 +383,44 @@ class CollectTweetsFlow(FlowSpec):
         Collects tweets per rules and query parameters and stores them in a dictionary
             to s3.
         """
-        for i in range(len(self.digital_ads_ruleset_twitter)):
-            # starting with an empty dictionary to store all data
-            print(f"fetching tweets for {i} query...")
-            data = empty_data_dict()
-
-            # Altering query parameters to account for each rule
-            self.query_parameters_twitter["query"] = self.digital_ads_ruleset_twitter[
-                i
-            ]["value"]
-            query_tag = self.digital_ads_ruleset_twitter[i]["tag"]
-
-            # Checking if we have info about the latest tweet ID collected for the query_tag
-            if (query_tag in self.max_ids_json.keys()) and (
-                "newest_id" in self.max_ids_json[query_tag].keys()
-            ):
-                # We only use the since_id param if that latest tweet ID collected was posted in the past 7 days
-                created_at = datetime.strptime(
-                    self.max_ids_json[query_tag]["created_at"], "%Y-%m-%dT%H:%M:%S.000Z"
+        token_pool = TokenPool(self.bearer_token_list)
+
+        # rules are collected concurrently, one worker per token, so several
+        # requests are in flight at once. Each worker updates its own copy of its
+        # tag's max_tweet_id.json entry, which is merged back and saved here.
+        with ThreadPoolExecutor(max_workers=len(token_pool)) as executor:
+            futures = {}
+            for rule in self.digital_ads_ruleset_twitter:
+                print(f"fetching tweets for {rule['tag']}...")
+                rule_max_ids_json = {
+                    rule["tag"]: deepcopy(self.max_ids_json.get(rule["tag"], {}))
+                }
+                future = executor.submit(
+                    collect_rule,
+                    token_pool,
+                    self.query_parameters_twitter,
+                    rule,
+                    rule_max_ids_json,
+                    self.date_time_collection_start,
                 )
-                if created_at + timedelta(7) > datetime.now():
-                    self.query_parameters_twitter["since_id"] = self.max_ids_json[
-                        query_tag
-                    ]["newest_id"]
-            else:
-                self.max_ids_json[query_tag] = dict()
-
-            # Collecting and processing data
-            json_response = connect_to_endpoint(
-                self.headers, self.query_parameters_twitter
-            )
-            data = process_twitter_data(json_response, data)
-
-            # updating json with info about max tweet id collected, to be used next time we collect data
-            # note that first page of tweets contains the newest possible tweets
-            if "newest_id" in json_response["meta"].keys():
-                # Updating json with max tweet id collected
-                update_max_ids_json(
-                    json_response,
+                futures[future] = rule_max_ids_json
+
+            for future in as_completed(futures):
+                data = future.result()
+                rule_max_ids_json = futures[future]
+                self.max_ids_json.update(rule_max_ids_json)
+                query_tag = next(iter(rule_max_ids_json))
+
+                # Saving data and max tweet id information to S3
+                print(f"saving tweets for {query_tag}...")
+                save_raw_data(
+                    data,
                     self.max_ids_json,
                     query_tag,
                     self.date_time_collection_start,
+                    self.production,
                 )
 
-            while "next_token" in json_response["meta"]:
-                query_parameters_twitter["next_token"] = json_response["meta"][
-                    "next_token"
-                ]
-
-                json_response = connect_to_endpoint(
-                    self.headers, query_parameters_twitter
-                )
-                data = process_twitter_data(json_response, data)
-
-            filename = f"recent_search_{query_tag}_{self.date_time_collection_start}_production_{str(self.production).lower()}.json"
-            # Saving data and max tweet id information to S3 or local folder
-            print(f"saving tweets for {i} query...")
-
-            dictionary_to_s3(data, BUCKET_NAME, RAW_DATA_COLLECTION_FOLDER, filename)
-            dictionary_to_s3(
-                self.max_ids_json,
-                BUCKET_NAME,
-                RAW_DATA_COLLECTION_FOLDER,
-                "max_tweet_id.json",
-            )
-
-            # Removing these from query parameters before collecting data for next rule
-            for key in ["query", "since_id"]:
-                self.query_parameters_twitter.pop(key, None)
-
         self.next(self.end)
 
     @step
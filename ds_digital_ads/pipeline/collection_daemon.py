@@ -0,0 +1,292 @@
+"""
+Long-running Twitter collection daemon that adapts how often each handle
+is polled to how often it posts.
+
+Each handle's posting rate is learnt from the collection history kept in
+max_tweet_id.json: busy advertisers are polled often and quiet ones rarely,
+so freshness improves for active advertisers while fewer API calls are used
+overall. Handles wait in a priority queue ordered by their next poll time and
+the polling intervals are stretched if needed so the total number of polls
+stays within a share of the bearer token pool's rate limit.
+
+Every poll writes a raw file and max_tweet_id.json exactly like the
+collect tweets flow, so the enrich tweets flow works unchanged.
+
+if you want to test the daemon (polls the first handle once and stops):
+python ds_digital_ads/pipeline/collection_daemon.py --max_polls 1
+
+if you want to run the daemon in production:
+python ds_digital_ads/pipeline/collection_daemon.py --production
+"""
+import argparse
+from datetime import datetime
+import heapq
+import os
+import time
+from typing import Dict, Optional
+
+from dotenv import load_dotenv
+
+from ds_digital_ads.utils.data_collection_utils import (
+    RAW_DATA_COLLECTION_FOLDER,
+    digital_ads_ruleset_twitter,
+    query_parameters_twitter,
+)
+from ds_digital_ads.utils.twitter_api_utils import TokenPool, parse_bearer_tokens
+from ds_digital_ads.pipeline.collect_tweets_flow import (
+    collect_rule,
+    get_max_ids_json,
+    save_raw_data,
+)
+from ds_digital_ads import BUCKET_NAME
+
+load_dotenv()
+
+# recent search requests allowed per token and per 15 minute window (app auth)
+REQUESTS_PER_WINDOW = 450
+# prior belief about a handle's posting rate: PRIOR_TWEETS tweets every PRIOR_HOURS
+PRIOR_TWEETS = 1
+PRIOR_HOURS = 24
+# minutes to wait before polling a tag again after a failed poll, doubled after
+# every consecutive failure of the same tag
+ERROR_BACKOFF_MINUTES = 5
+
+
+def posting_rate(max_ids_entry: dict) -> float:
+    """
+    Estimates a handle's posting rate (tweets per hour) from its collection history.
+    A weak prior keeps the estimate sensible for handles with little history.
+
+    Args:
+        max_ids_entry: max_tweet_id.json entry for the handle's query tag
+    Returns:
+        Estimated number of tweets posted per hour.
+    """
+    history = max_ids_entry.get("history", [])
+    n_tweets = sum(collection["n_tweets"] for collection in history)
+    hours = sum(collection["window_hours"] for collection in history)
+
+    return (n_tweets + PRIOR_TWEETS) / (hours + PRIOR_HOURS)
+
+
+def poll_intervals(
+    max_ids_json: dict,
+    tags: list,
+    n_tokens: int,
+    target_new_tweets: float = 1,
+    min_interval_hours: float = 0.25,
+    max_interval_hours: float = 24,
+    budget_share: float = 0.5,
+) -> Dict[str, float]:
+    """
+    Works out how many hours to wait between two polls of each query tag, so
+    that each poll finds about target_new_tweets new tweets. Intervals are
+    stretched proportionally if the total number of polls per hour would use
+    more than budget_share of the pool's rate limit.
+
+    Args:
+        max_ids_json: dictionary with latest tweet IDs and collection history
+        tags: query tags to poll
+        n_tokens: number of bearer tokens in the pool
+        target_new_tweets: number of new tweets we want each poll to find
+        min_interval_hours: shortest interval between two polls of a tag
+        max_interval_hours: longest interval between two polls of a tag
+        budget_share: share of the rate limit the daemon can use
+    Returns:
+        Dictionary with the polling interval (in hours) of each tag.
+    """
+    intervals = {
+        tag: min(
+            max(
+                target_new_tweets / posting_rate(max_ids_json.get(tag, {})),
+                min_interval_hours,
+            ),
+            max_interval_hours,
+        )
+        for tag in tags
+    }
+
+    # every poll costs at least one request
+    polls_per_hour = sum(1 / interval for interval in intervals.values())
+    budget_per_hour = n_tokens * REQUESTS_PER_WINDOW * 4 * budget_share
+    if polls_per_hour > budget_per_hour:
+        intervals = {
+            tag: interval * polls_per_hour / budget_per_hour
+            for tag, interval in intervals.items()
+        }
+
+    return intervals
+
+
+def last_collection_time(max_ids_entry: dict) -> Optional[float]:
+    """
+    Returns the timestamp of the latest collection of a query tag, if any.
+
+    Args:
+        max_ids_entry: max_tweet_id.json entry for the query tag
+    """
+    history = max_ids_entry.get("history")
+    collection_datetime = (
+        history[-1]["collection_datetime"]
+        if history
+        else max_ids_entry.get("collection_datetime")
+    )
+    if collection_datetime is None:
+        return None
+
+    return datetime.strptime(collection_datetime, "%Y_%m_%d_%H_%M_%S").timestamp()
+
+
+def run_collection_daemon(
+    bearer_token_list: list,
+    production: bool = False,
+    target_new_tweets: float = 1,
+    min_interval_hours: float = 0.25,
+    max_interval_hours: float = 24,
+    budget_share: float = 0.5,
+    max_polls: Optional[int] = None,
+):
+    """
+    Polls every query tag forever (or for max_polls polls), always polling the tag
+    that is due next and rescheduling it according to its learnt posting rate.
+
+    Args:
+        bearer_token_list: list of bearer tokens
+        production: whether to run in production
+        target_new_tweets: number of new tweets we want each poll to find
+        min_interval_hours: shortest interval between two polls of a tag
+        max_interval_hours: longest interval between two polls of a tag
+        budget_share: share of the rate limit the daemon can use
+        max_polls: number of polls after which the daemon stops
+    """
+    token_pool = TokenPool(bearer_token_list)
+    max_ids_json = get_max_ids_json(BUCKET_NAME, RAW_DATA_COLLECTION_FOLDER)
+    parameters = dict(query_parameters_twitter)
+    parameters["max_results"] = 100 if production else 10
+    rules = {
+        rule["tag"]: rule
+        for rule in (
+            digital_ads_ruleset_twitter
+            if production
+            else digital_ads_ruleset_twitter[:1]
+        )
+    }
+
+    def intervals() -> Dict[str, float]:
+        return poll_intervals(
+            max_ids_json,
+            list(rules),
+            len(token_pool),
+            target_new_tweets,
+            min_interval_hours,
+            max_interval_hours,
+            budget_share,
+        )
+
+    # priority queue of (next poll timestamp, tag), tags never collected go first
+    now = time.time()
+    queue = []
+    for tag, interval in intervals().items():
+        last_collection = last_collection_time(max_ids_json.get(tag, {}))
+        due = now if last_collection is None else last_collection + interval * 3600
+        queue.append((due, tag))
+    heapq.heapify(queue)
+
+    n_polls = 0
+    n_failures = {tag: 0 for tag in rules}
+    while queue and (max_polls is None or n_polls < max_polls):
+        due, tag = heapq.heappop(queue)
+        time.sleep(max(due - time.time(), 0))
+
+        date_time_collection_start = datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
+        print(f"fetching tweets for {tag}...")
+        n_polls += 1
+        try:
+            data = collect_rule(
+                token_pool,
+                parameters,
+                rules[tag],
+                max_ids_json,
+                date_time_collection_start,
+            )
+
+            save_raw_data(
+                data, max_ids_json, tag, date_time_collection_start, production
+            )
+        except Exception as e:
+            # a failed poll must not stop the daemon: retry the tag later
+            backoff_hours = min(
+                ERROR_BACKOFF_MINUTES * 2 ** n_failures[tag] / 60, max_interval_hours
+            )
+            n_failures[tag] += 1
+            print(
+                f"Poll of {tag} failed ({type(e).__name__}: {e}), "
+                f"retrying in {backoff_hours:.2f} hours"
+            )
+            heapq.heappush(queue, (time.time() + backoff_hours * 3600, tag))
+            continue
+        n_failures[tag] = 0
+
+        interval = intervals()[tag]
+        print(
+            f"{len(data.data)} new tweets for {tag}, next poll in {interval:.2f} hours"
+        )
+        heapq.heappush(queue, (time.time() + interval * 3600, tag))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--production", action="store_true", help="Run in production?")
+    parser.add_argument(
+        "--target_new_tweets",
+        type=float,
+        default=1,
+        help="Number of new tweets each poll should find",
+    )
+    parser.add_argument(
+        "--min_interval_hours",
+        type=float,
+        default=0.25,
+        help="Shortest interval between two polls of a handle",
+    )
+    parser.add_argument(
+        "--max_interval_hours",
+        type=float,
+        default=24,
+        help="Longest interval between two polls of a handle",
+    )
+    parser.add_argument(
+        "--budget_share",
+        type=float,
+        default=0.5,
+        help="Share of the rate limit the daemon can use",
+    )
+    parser.add_argument(
+        "--max_polls", type=int, default=None, help="Stop after this many polls"
+    )
+    parser.add_argument(
+        "--bearer_tokens",
+        default=None,
+        help="Comma separated Twitter bearer tokens to pool requests across",
+    )
+    args = parser.parse_args()
+
+    bearer_token_list = parse_bearer_tokens(
+        args.bearer_tokens,
+        os.environ.get("BEARER_TOKEN"),
+        os.environ.get("BEARER_TOKENS"),
+    )
+    if not bearer_token_list:
+        print(
+            "BEARER_TOKEN or BEARER_TOKENS environment variable not set. Please set it and try again."
+        )
+    else:
+        run_collection_daemon(
+            bearer_token_list,
+            production=args.production,
+            target_new_tweets=args.target_new_tweets,
+            min_interval_hours=args.min_interval_hours,
+            max_interval_hours=args.max_interval_hours,
+            budget_share=args.budget_share,
+            max_polls=args.max_polls,
+        )
@@ -3,13 +3,26 @@ Flow to enrich tweets by:
     - concatenating .json files per twitter account into one json;
     - creating a media table with image URLs and a media id key;
     - creating a core table with all tweets, tweet ids, media ids and their public metrics;
-    - saving twitter images to S3.
+    - creating deduplicated users and places dimension tables keyed by id, with
+      the last seen version of each user and place;
+    - creating an advertisers dimension table mapping twitter handles to parent
+      companies, and joining the parent company to the core table;
+    - grouping near-duplicate tweets into campaigns with MinHash LSH and adding
+      a campaign_id column to the core table;
+    - incrementally updating an inverted full-text index over tweet text,
+      hashtags, url titles and url descriptions;
+    - saving twitter images to S3;
+    - decoding each new image once on a process pool to save a thumbnail and
+      compute a perceptual hash, and grouping duplicate creatives.
 
 if you want to test the flow:
 python ds_digital_ads/pipeline/enrich_tweets_flow.py run
 
 if you want to run the flow in production:
 python ds_digital_ads/pipeline/enrich_tweets_flow.py run --production True
+
+if you only want to enrich the tweets collected between two dates:
+python ds_digital_ads/pipeline/enrich_tweets_flow.py run --start_date 2023-07-01 --end_date 2023-07-31
 """
 from metaflow import FlowSpec, step, Parameter
 
@@ -20,12 +33,195 @@ import os
 from typing import List
 
 from ds_digital_ads import BUCKET_NAME
-from ds_digital_ads.utils.data_collection_utils import PROCESSED_DATA_COLLECTION_FOLDER
+from ds_digital_ads.utils.data_collection_utils import (
+    PROCESSED_DATA_COLLECTION_FOLDER,
+    gambling_advertisers_uk,
+    parse_raw_data_path,
+)
 from ds_digital_ads.getters.data_getters import save_to_s3, save_images_to_s3
+from ds_digital_ads.utils.twitter_models import (
+    Entities,
+    Media,
+    Tweet,
+    TweetPublicMetrics,
+)
+
+CORE_COLUMNS = [
+    "id",
+    "media_id",
+    "author_id",
+    "name",
+    "created_at",
+    "lang",
+    "text",
+    "public_metrics_retweet_count",
+    "public_metrics_reply_count",
+    "public_metrics_like_count",
+    "public_metrics_quote_count",
+    "public_metrics_bookmark_count",
+    "public_metrics_impression_count",
+    "hashtags",
+    "url_titles",
+    "url_descriptions",
+    "mentions",
+]
+MEDIA_COLUMNS = [
+    "media_id",
+    "type",
+    "url",
+    "duration_ms",
+    "height",
+    "width",
+    "alt_text",
+    "public_metrics",
+    "variants",
+]
+
+
+def parse_raw_file_name(file_path: str) -> tuple:
+    """
+    Parses the query tag and collection date time out of a partitioned raw file
+    path (.../tag={tag}/date={%Y-%m-%d}/recent_search_{tag}_{timestamp}_production_{bool}.json).
+    The tag is read from its partition rather than split out of the file name,
+    so tags can contain underscores.
+
+    Args:
+        file_path: path to the raw file
+    Returns:
+        Tuple with the query tag and the collection date time.
+    """
+    query_tag = parse_raw_data_path(file_path)["tag"]
+    name = file_path.split("/")[-1].split("_production_")[0]
+
+    return query_tag, name[len(f"recent_search_{query_tag}_") :]
+
+
+def core_record(tweet: Tweet, name: str) -> dict:
+    """
+    Creates a core table record from a tweet's attributes.
+
+    Args:
+        tweet: decoded tweet
+        name: twitter handle the tweet was collected for
+    Returns:
+        Dictionary with the CORE_COLUMNS of the tweet (media_id is the list of
+        its media keys, exploded into one row per media key later).
+    """
+    public_metrics = tweet.public_metrics or TweetPublicMetrics()
+    entities = tweet.entities or Entities()
+
+    return {
+        "id": tweet.id,
+        "media_id": tweet.attachments.media_keys if tweet.attachments else None,
+        "author_id": tweet.author_id,
+        "name": name,
+        "created_at": tweet.created_at,
+        "lang": tweet.lang,
+        "text": tweet.text,
+        "public_metrics_retweet_count": public_metrics.retweet_count,
+        "public_metrics_reply_count": public_metrics.reply_count,
+        "public_metrics_like_count": public_metrics.like_count,
+        "public_metrics_quote_count": public_metrics.quote_count,
+        "public_metrics_bookmark_count": public_metrics.bookmark_count,
+        "public_metrics_impression_count": public_metrics.impression_count,
+        "hashtags": [hashtag.tag for hashtag in entities.hashtags],
+        "url_titles": [url.title for url in entities.urls],
+        "url_descriptions": [url.description for url in entities.urls],
+        "mentions": [mention.username for mention in entities.mentions],
+    }
+
+
+def media_record(media: Media) -> dict:
+    """
+    Creates a media table record from a media's attributes, using the preview
+    image of videos as their url.
+
+    Args:
+        media: decoded media
+    Returns:
+        Dictionary with the MEDIA_COLUMNS of the media.
+    """
+    return {
+        "media_id": media.media_key,
+        "type": media.type,
+        "url": media.url or media.preview_image_url,
+        "duration_ms": media.duration_ms,
+        "height": media.height,
+        "width": media.width,
+        "alt_text": media.alt_text,
+        "public_metrics": (
+            media.public_metrics.view_count if media.public_metrics else None
+        ),
+        "variants": media.variants,
+    }
+
+
+def dimension_table(records: List[dict]) -> pd.DataFrame:
+    """
+    Creates a dimension table keyed by id from records collected at different
+    times, keeping the last seen version of each record. Nested fields are
+    flattened into columns.
+
+    Args:
+        records: list of dictionaries with an "id" and a "last_seen" date time
+    """
+    if not records:
+        return pd.DataFrame(columns=["id", "last_seen"])
+
+    dimension_df = pd.json_normalize(records, sep="_")
+
+    return (
+        dimension_df.sort_values("last_seen", kind="stable")
+        .drop_duplicates(subset="id", keep="last")
+        .reset_index(drop=True)
+    )
+
+
+def advertisers_table(advertisers: dict = gambling_advertisers_uk) -> pd.DataFrame:
+    """
+    Creates an advertisers dimension table with one row per twitter handle,
+    mapping handles to their parent company, google ad id and brands.
+
+    Args:
+        advertisers: dictionary of advertisers per parent company
+    """
+    rows = []
+    for parent_company, advertiser in advertisers.items():
+        handles = advertiser["twitter_handle"]
+        for handle in [handles] if isinstance(handles, str) else handles:
+            rows.append(
+                {
+                    "twitter_handle": handle,
+                    "handle_key": handle.lower(),
+                    "parent_company": parent_company,
+                    "google_id": advertiser["google_id"],
+                    "brands": advertiser["brand"],
+                }
+            )
+
+    return pd.DataFrame(rows).drop_duplicates(subset="handle_key")
 
 
 class EnrichTweetsFlow(FlowSpec):
     production = Parameter("production", help="Run in production?", default=False)
+    max_workers = Parameter(
+        "max_workers",
+        help="Number of processes extracting image features",
+        default=os.cpu_count(),
+        type=int,
+    )
+    start_date = Parameter(
+        "start_date",
+        help="First collection date to enrich (%Y-%m-%d), all dates if not set",
+        default=None,
+        type=str,
+    )
+    end_date = Parameter(
+        "end_date",
+        help="Last collection date to enrich (%Y-%m-%d), all dates if not set",
+        default=None,
+        type=str,
+    )
 
     @step
     def start(self):
@@ -37,34 +233,65 @@ class EnrichTweetsFlow(FlowSpec):
     @step
     def load_data(self):
         """
-        Loads and concatenates collected tweets from S3.
+        Loads and concatenates collected tweets from S3, only listing the
+        production partitions collected between start_date and end_date.
+        Files that do not match the twitter models are skipped.
         """
-        from ds_digital_ads.getters.data_getters import load_s3_data, get_s3_data_paths
+        import msgspec
+        from ds_digital_ads.getters.data_getters import load_s3_bytes, get_s3_data_paths
         from ds_digital_ads.utils.data_collection_utils import (
             RAW_DATA_COLLECTION_FOLDER,
         )
+        from ds_digital_ads.utils.twitter_models import (
+            decode_search_response,
+            flatten_model,
+        )
 
         raw_tweet_files = get_s3_data_paths(
-            BUCKET_NAME, RAW_DATA_COLLECTION_FOLDER, file_types=["*.json"]
+            BUCKET_NAME,
+            RAW_DATA_COLLECTION_FOLDER,
+            file_types=["*.json"],
+            env="production",
+            start_date=self.start_date,
+            end_date=self.end_date,
         )
 
         raw_tweet_files = raw_tweet_files if self.production else raw_tweet_files[:5]
 
-        all_tweets_dfs = []
+        core_data = []
         self.media_data = []
+        self.users_data = []
+        self.places_data = []
         self.all_tweets = {}
+        self.skipped_files = []
         for tweet_file in raw_tweet_files:
-            if "production_true" in tweet_file:
-                tweets = load_s3_data(BUCKET_NAME, tweet_file)
-                name = tweet_file.split("/")[-1].split("_")[2]
-                tweet_df = pd.DataFrame(tweets["data"])
-                tweet_df["name"] = name
-
-                self.media_data.extend(tweets["includes"]["media"])
-                all_tweets_dfs.append(tweet_df)
-                self.all_tweets = name
-
-        self.all_tweets_df = pd.concat(all_tweets_dfs)
+            try:
+                tweets = decode_search_response(load_s3_bytes(BUCKET_NAME, tweet_file))
+            except msgspec.DecodeError as e:
+                # one malformed or drifted file must not stop the enrichment
+                print(f"skipping {tweet_file}, it does not match the models: {e}")
+                self.skipped_files.append(tweet_file)
+                continue
+            query_tag, collection_datetime = parse_raw_file_name(tweet_file)
+            name = query_tag[: -len("_promotions")]
+
+            core_data.extend(core_record(tweet, name) for tweet in tweets.data)
+            self.media_data.extend(
+                media_record(media) for media in tweets.includes.media
+            )
+            for include, data in [
+                ("users", self.users_data),
+                ("places", self.places_data),
+            ]:
+                data.extend(
+                    dict(flatten_model(item), last_seen=collection_datetime)
+                    for item in getattr(tweets.includes, include)
+                )
+            self.all_tweets = name
+
+        if self.skipped_files:
+            print(f"{len(self.skipped_files)} raw files skipped")
+        self.all_tweets_df = pd.DataFrame(core_data, columns=CORE_COLUMNS)
 
         self.next(self.clean_media_data)
 
@@ -73,17 +300,8 @@ class EnrichTweetsFlow(FlowSpec):
         """
         clean and create media dataframe from raw data.
         """
-        self.media_df = pd.DataFrame(self.media_data)
-        print(self.media_df.columns)
-        self.media_df["public_metrics"] = self.media_df["public_metrics"].apply(
-            lambda x: x["view_count"] if isinstance(x, dict) else None
-        )
-        self.media_df["url"].fillna(self.media_df["preview_image_url"], inplace=True)
-        self.media_df.drop(columns=["preview_image_url"], inplace=True)
-        self.media_df["image_name"] = self.media_df["url"].apply(
-            lambda x: x.split("/")[-1]
-        )
-        self.media_df.rename(columns={"media_key": "media_id"}, inplace=True)
+        self.media_df = pd.DataFrame(self.media_data, columns=MEDIA_COLUMNS)
+        self.media_df["image_name"] = self.media_df["url"].str.split("/").str[-1]
 
         self.next(self.clean_core_data)
 
@@ -92,62 +310,224 @@ class EnrichTweetsFlow(FlowSpec):
         """
         Clean up core dataframe.
         """
-        # clean up core dataframe
-        self.all_tweets_df = self.all_tweets_df.assign(
-            created_at=lambda x: pd.to_datetime(x["created_at"])
+        # one row per tweet and media key
+        self.all_tweets_df = (
+            self.all_tweets_df.assign(
+                created_at=lambda x: pd.to_datetime(x["created_at"])
+            )
+            .explode("media_id")
+            .reset_index(drop=True)
+        )
+
+        self.next(self.build_dimension_tables)
+
+    @step
+    def build_dimension_tables(self):
+        """
+        Build deduplicated users, places and advertisers dimension tables and
+        join the parent company of each tweet's author to the core table.
+        """
+        self.users_df = dimension_table(self.users_data)
+        self.places_df = dimension_table(self.places_data)
+        self.advertisers_df = advertisers_table()
+
+        # vectorised lookups: author id -> username -> parent company, falling
+        # back on the handle the tweet was collected for
+        usernames = self.all_tweets_df["author_id"].map(
+            self.users_df.set_index("id")["username"]
+            if "username" in self.users_df.columns
+            else {}
         )
-        self.all_tweets_df["media_id"] = self.all_tweets_df["attachments"].apply(
-            lambda x: x["media_keys"] if x else None
+        handle_keys = usernames.fillna(self.all_tweets_df["name"]).str.lower()
+        self.all_tweets_df["parent_company"] = handle_keys.map(
+            self.advertisers_df.set_index("handle_key")["parent_company"]
         )
 
-        # add public metrics to the beginning of the df
-        public_metrics_df = (
-            self.all_tweets_df["public_metrics"]
-            .apply(pd.Series)
-            .add_prefix("public_metrics_")
+        self.next(self.assign_campaigns)
+
+    @step
+    def assign_campaigns(self):
+        """
+        Match tweets against the near-duplicate campaign index, add their
+        campaign_id to the core table and save the updated index to s3.
+        """
+        from ds_digital_ads.utils.near_duplicate_utils import (
+            campaign_index_path,
+            get_campaign_index,
         )
-        self.all_tweets_df = pd.concat([self.all_tweets_df, public_metrics_df], axis=1)
-        self.all_tweets_df.drop(columns=["public_metrics", "attachments"], inplace=True)
 
-        self.all_tweets_df = (
-            self.all_tweets_df.assign(
-                hashtags=lambda x: x["entities"].apply(
-                    lambda y: [tag["tag"] for tag in y.get("hashtags", [])]
-                ),
-                url_titles=lambda x: x["entities"].apply(
-                    lambda y: [url.get("title") for url in y.get("urls", [])]
-                ),
-                url_descriptions=lambda x: x["entities"].apply(
-                    lambda y: [url.get("description") for url in y.get("urls", [])]
-                ),
-                mentions=lambda x: x["entities"].apply(
-                    lambda y: [mention["username"] for mention in y.get("mentions", [])]
-                ),
+        campaign_index = get_campaign_index(self.production)
+        n_indexed = len(campaign_index)
+        # oldest tweets first, so a campaign is named after its first tweet
+        tweets_df = self.all_tweets_df.drop_duplicates(subset="id").sort_values(
+            "created_at"
+        )
+        campaign_ids = {
+            str(tweet_id): campaign_index.add(tweet_id, text)
+            for tweet_id, text in zip(tweets_df["id"], tweets_df["text"])
+        }
+        self.all_tweets_df["campaign_id"] = (
+            self.all_tweets_df["id"].astype(str).map(campaign_ids)
+        )
+        print(
+            f"{len(campaign_index) - n_indexed} tweets added to the campaign index, "
+            f"{self.all_tweets_df['campaign_id'].nunique()} campaigns..."
+        )
+
+        if len(campaign_index) > n_indexed:
+            save_to_s3(
+                BUCKET_NAME,
+                campaign_index.to_dict(),
+                campaign_index_path(self.production),
             )
-            .drop(columns=["entities"])[
+
+        self.next(self.update_text_index)
+
+    @step
+    def update_text_index(self):
+        """
+        Add new tweets to the full-text index and save it to s3.
+        """
+        from ds_digital_ads.utils.text_index_utils import (
+            get_text_index,
+            text_index_path,
+        )
+
+        text_index = get_text_index(self.production)
+        n_indexed = len(text_index)
+        tweets_df = self.all_tweets_df.drop_duplicates(subset="id")
+        for tweet_id, text, hashtags, url_titles, url_descriptions in zip(
+            tweets_df["id"],
+            tweets_df["text"],
+            tweets_df["hashtags"],
+            tweets_df["url_titles"],
+            tweets_df["url_descriptions"],
+        ):
+            text_index.add_document(
+                tweet_id,
                 [
-                    "id",
-                    "media_id",
-                    "name",
-                    "created_at",
-                    "lang",
-                    "text",
-                    "public_metrics_retweet_count",
-                    "public_metrics_reply_count",
-                    "public_metrics_like_count",
-                    "public_metrics_quote_count",
-                    "public_metrics_bookmark_count",
-                    "public_metrics_impression_count",
-                    "hashtags",
-                    "url_titles",
-                    "url_descriptions",
-                    "mentions",
-                ]
-            ]
-            .explode("media_id")
-            .reset_index(drop=True)
+                    text,
+                    " ".join(hashtags),
+                    " ".join(filter(None, url_titles)),
+                    " ".join(filter(None, url_descriptions)),
+                ],
+            )
+        print(f"{len(text_index) - n_indexed} tweets added to the text index...")
+
+        if len(text_index) > n_indexed:
+            save_to_s3(
+                BUCKET_NAME, text_index.to_dict(), text_index_path(self.production)
+            )
+
+        self.next(self.save_images)
+
+    @step
+    def save_images(self):
+        """
+        Save the twitter images not archived yet to s3.
+        """
+        from ds_digital_ads.getters.data_getters import get_s3_data_paths
+        from ds_digital_ads.utils.image_utils import IMAGES_FOLDER
+
+        archived_images = {
+            image_path.split("/")[-1]
+            for image_path in get_s3_data_paths(
+                BUCKET_NAME, IMAGES_FOLDER + "/", file_types="*", recursive=False
+            )
+        }
+        new_images = self.media_df.dropna(subset=["url"]).drop_duplicates("url")
+        new_images = new_images[~new_images["image_name"].isin(archived_images)]
+        print(f"save {len(new_images)} new images...")
+        save_images_to_s3(
+            image_urls=new_images["url"].tolist(),
+            output_folder=PROCESSED_DATA_COLLECTION_FOLDER,
+        )
+
+        self.next(self.extract_image_features)
+
+    @step
+    def extract_image_features(self):
+        """
+        Decode each new image once on a process pool to save its thumbnail and
+        compute its perceptual hash, then group duplicate creatives across
+        media keys and save the image hash index to s3.
+        """
+        from concurrent.futures import ProcessPoolExecutor
+        from ds_digital_ads.getters.data_getters import load_s3_data, get_s3_data_paths
+        from ds_digital_ads.utils.image_utils import (
+            extract_image_features,
+            group_similar_hashes,
+            image_hash_index_path,
+        )
+
+        index_path = image_hash_index_path(self.production)
+        image_hash_index = (
+            load_s3_data(BUCKET_NAME, index_path)
+            if index_path in get_s3_data_paths(BUCKET_NAME, index_path, "*.json")
+            else {"images": {}, "creatives": {}}
+        )
+        images = image_hash_index["images"]
+
+        new_images = [
+            image_name
+            for image_name in self.media_df["image_name"].dropna().unique()
+            if image_name not in images
+        ]
+        print(f"extracting features of {len(new_images)} new images...")
+        with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            for features in executor.map(
+                extract_image_features, new_images, chunksize=16
+            ):
+                # images that could not be processed are retried next time
+                if features["phash"] is not None:
+                    images[features.pop("image_name")] = features
+
+        creative_hashes = group_similar_hashes(
+            [features["phash"] for features in images.values()]
+        )
+        # creative ids are kept in the index so they do not depend on which raw
+        # files are loaded: images are iterated in the order they were indexed,
+        # so a creative keeps the id of its oldest image even if groups merge,
+        # and a new creative is identified by the first media key of its first image
+        previous_creative_ids = image_hash_index.get("creative_ids", {})
+        first_media_ids = self.media_df.drop_duplicates("image_name").set_index(
+            "image_name"
+        )["media_id"]
+        creative_ids = {}
+        image_hash_index["creatives"] = {}
+        for image_name, features in images.items():
+            creative_hash = creative_hashes[features["phash"]]
+            if creative_hash not in creative_ids:
+                creative_ids[creative_hash] = previous_creative_ids.get(
+                    features.get("creative_hash"),
+                    first_media_ids.get(image_name, image_name),
+                )
+            features["creative_hash"] = creative_hash
+            image_hash_index["creatives"].setdefault(creative_hash, []).append(
+                image_name
+            )
+        image_hash_index["creative_ids"] = creative_ids
+
+        features_df = pd.DataFrame.from_dict(images, orient="index")
+        self.media_df = self.media_df.merge(
+            features_df.reindex(columns=["phash", "thumbnail_path", "creative_hash"]),
+            how="left",
+            left_on="image_name",
+            right_index=True,
+        )
+        # media whose image could not be processed are their own creative
+        self.media_df["creative_id"] = (
+            self.media_df["creative_hash"]
+            .map(creative_ids)
+            .fillna(self.media_df["media_id"])
+        )
+        print(
+            f"{self.media_df['media_id'].nunique()} media keys, "
+            f"{self.media_df['creative_id'].nunique()} unique creatives..."
         )
 
+        save_to_s3(BUCKET_NAME, image_hash_index, index_path)
+
         self.next(self.save_data)
 
     @step
@@ -175,6 +555,18 @@ class EnrichTweetsFlow(FlowSpec):
         )
         save_to_s3(BUCKET_NAME, self.all_tweets_df, core_path)
 
+        print("saving dimension tables...")
+        for table_name, table_df in [
+            ("users", self.users_df),
+            ("places", self.places_df),
+            ("advertisers", self.advertisers_df),
+        ]:
+            table_path = os.path.join(
+                PROCESSED_DATA_COLLECTION_FOLDER,
+                f"{table_name}_table_{str(self.production).lower()}_{date}.csv",
+            )
+            save_to_s3(BUCKET_NAME, table_df, table_path)
+
         print("save concatenated tweets...")
         core_concat_path = os.path.join(
             PROCESSED_DATA_COLLECTION_FOLDER,
@@ -182,12 +574,6 @@ class EnrichTweetsFlow(FlowSpec):
         )
         save_to_s3(BUCKET_NAME, self.all_tweets, core_concat_path)
 
-        print("save images...")
-        image_list = self.media_df["url"].unique().tolist()
-        save_images_to_s3(
-            image_urls=image_list, output_folder=PROCESSED_DATA_COLLECTION_FOLDER
-        )
-
         self.next(self.end)
 
     @step
@@ -0,0 +1,231 @@
+"""
+Local stand-in of the Google Ads Transparency Center search endpoint, to run and
+check the Google ads collection without calling Google.
+
+The stand-in serves fixture pages of creatives in the endpoint's format for
+every advertiser id in google_advertiser_ids: it parses the `f.req` form field
+like the endpoint, answers a payload it does not recognise with HTTP 400, and
+follows the page tokens (newest creatives first, FIXTURE_PAGES pages).
+
+if you want to run the collection flow against the stand-in:
+python ds_digital_ads/pipeline/google_ads_stand_in.py
+python ds_digital_ads/pipeline/collect_google_ads_flow.py run --endpoint_url http://localhost:8000
+
+if you want to check the payload, parsing, pagination and state updates of the
+collection against the stand-in:
+python ds_digital_ads/pipeline/google_ads_stand_in.py --check
+"""
+import argparse
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+from urllib.parse import parse_qs
+
+from ds_digital_ads.utils.data_collection_utils import (
+    GOOGLE_ADS_PAGE_SIZE,
+    GOOGLE_ADS_REGION_UK,
+    google_advertiser_ids,
+)
+from ds_digital_ads.utils.google_ads_api_utils import RateLimiter
+from ds_digital_ads.pipeline.collect_google_ads_flow import (
+    collect_advertiser,
+    update_max_last_shown_json,
+)
+
+FIXTURE_PAGES = 3
+FIXTURE_PAGE_SIZE = 2
+# last shown timestamp of the newest fixture creative, older ones are a day apart
+FIXTURE_LAST_SHOWN = 1_700_000_000
+
+
+def fixture_creative(advertiser_id: str, number: int) -> dict:
+    """
+    Returns the fixture creative number `number` of an advertiser (0 is the
+    newest), in the format of the endpoint's responses. Even creatives are
+    image ads with a preview url, odd ones text ads rendered as html.
+
+    Args:
+        advertiser_id: Google advertiser id
+        number: rank of the creative by last shown date
+    """
+    last_shown = FIXTURE_LAST_SHOWN - number * 86400
+    preview_url = f"https://tpc.googlesyndication.com/{advertiser_id}/{number}.png"
+    content = (
+        {"1": {"4": preview_url}}
+        if number % 2 == 0
+        else {"3": {"2": f"<img src='{preview_url}' height='100'>"}}
+    )
+
+    return {
+        "1": advertiser_id,
+        "2": f"CR{advertiser_id[2:]}{number:04d}",
+        "3": content,
+        "4": 2 if number % 2 == 0 else 1,
+        "6": {"1": str(last_shown - 30 * 86400)},
+        "7": {"1": str(last_shown)},
+        "12": f"Advertiser {advertiser_id}",
+    }
+
+
+def fixture_page(advertiser_id: str, page_token: Optional[str]) -> dict:
+    """
+    Returns a page of the fixture creatives of an advertiser, with the token of
+    the next page unless it is the last page.
+
+    Args:
+        advertiser_id: Google advertiser id
+        page_token: token of the page, first page if None
+    """
+    page = int(page_token) if page_token else 0
+    response = {
+        "1": [
+            fixture_creative(advertiser_id, page * FIXTURE_PAGE_SIZE + number)
+            for number in range(FIXTURE_PAGE_SIZE)
+        ]
+    }
+    if page + 1 < FIXTURE_PAGES:
+        response["2"] = str(page + 1)
+
+    return response
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Answers search requests with fixture pages and records their payloads."""
+
+    requests: List[dict] = []
+
+    def do_POST(self):
+        form = parse_qs(self.rfile.read(int(self.headers["Content-Length"])).decode())
+        try:
+            request = json.loads(form["f.req"][0])
+            advertiser_id = request["3"]["13"]["1"][0]
+            valid = (
+                request["3"]["8"] == [GOOGLE_ADS_REGION_UK]
+                and request["2"] == GOOGLE_ADS_PAGE_SIZE
+                and advertiser_id in google_advertiser_ids.values()
+            )
+        except (KeyError, IndexError, TypeError, ValueError):
+            valid = False
+        if not valid:
+            self.send_error(400, "Unexpected f.req payload")
+            return
+
+        self.requests.append(request)
+        body = json.dumps(fixture_page(advertiser_id, request.get("4"))).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stand_in(port: int = 8000) -> ThreadingHTTPServer:
+    """
+    Starts the stand-in endpoint in a background thread.
+
+    Args:
+        port: port to listen on (0 picks a free port)
+    Returns:
+        Running server, its url is http://localhost:{server.server_port}.
+    """
+    server = ThreadingHTTPServer(("localhost", port), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+
+def check_collection():
+    """
+    Collects an advertiser from the stand-in twice, a full then an incremental
+    collection, and checks the requests made, the parsed creatives, the
+    pagination and the max last shown state.
+    """
+    server = start_stand_in(port=0)
+    endpoint_url = f"http://localhost:{server.server_port}"
+    rate_limiter = RateLimiter(requests_per_minute=6000)
+    parent_company, advertiser_id = next(iter(google_advertiser_ids.items()))
+    n_creatives = FIXTURE_PAGES * FIXTURE_PAGE_SIZE
+    try:
+        creatives = collect_advertiser(
+            rate_limiter, advertiser_id, endpoint_url=endpoint_url
+        )
+        page_tokens = [request.get("4") for request in StandInHandler.requests]
+        assert page_tokens == [None, "1", "2"], page_tokens
+        assert len(creatives) == n_creatives, len(creatives)
+        for number, creative in enumerate(creatives):
+            assert (
+                creative["creative_id"] == fixture_creative(advertiser_id, number)["2"]
+            )
+            assert creative["advertiser_id"] == advertiser_id
+            assert creative["format"] == ("image" if number % 2 == 0 else "text")
+            assert creative["preview_url"].endswith(f"/{advertiser_id}/{number}.png")
+            assert creative["last_shown"].startswith("20")
+
+        max_last_shown_json = {}
+        update_max_last_shown_json(
+            max_last_shown_json,
+            parent_company,
+            advertiser_id,
+            creatives,
+            "2024_01_01_00_00_00",
+        )
+        state = max_last_shown_json[parent_company]
+        assert state["last_shown_timestamp"] == FIXTURE_LAST_SHOWN, state
+        assert state["n_creatives"] == n_creatives, state
+
+        # only the creatives newer than the state are collected, and pagination
+        # stops at the first page with creatives already collected
+        StandInHandler.requests.clear()
+        new_creatives = collect_advertiser(
+            rate_limiter,
+            advertiser_id,
+            max_last_shown=FIXTURE_LAST_SHOWN - 86400,
+            endpoint_url=endpoint_url,
+        )
+        assert [creative["creative_id"] for creative in new_creatives] == [
+            creatives[0]["creative_id"]
+        ], new_creatives
+        assert len(StandInHandler.requests) == 1, StandInHandler.requests
+        update_max_last_shown_json(
+            max_last_shown_json,
+            parent_company,
+            advertiser_id,
+            new_creatives,
+            "2024_01_02_00_00_00",
+        )
+        assert state["last_shown_timestamp"] == FIXTURE_LAST_SHOWN, state
+        assert state["n_creatives"] == 1, state
+        assert state["collection_datetime"] == "2024_01_02_00_00_00", state
+    finally:
+        server.shutdown()
+        server.server_close()
+        StandInHandler.requests.clear()
+
+    print(f"collection checked against the stand-in ({n_creatives} creatives)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Local stand-in of the Google Ads Transparency Center endpoint."
+    )
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen on")
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="Check the collection against the stand-in, then exit",
+    )
+    args = parser.parse_args()
+
+    if args.check:
+        check_collection()
+    else:
+        server = start_stand_in(args.port)
+        print(f"stand-in endpoint listening on http://localhost:{args.port}")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            server.shutdown()
@@ -0,0 +1,124 @@
+"""
+One-off script to move raw tweet files from the old flat layout
+(RAW_DATA_COLLECTION_FOLDER/recent_search_{tag}_{timestamp}_production_{bool}.json)
+to the partitioned layout written by the collection flows
+(RAW_DATA_COLLECTION_FOLDER/env={production|test}/tag={tag}/date={%Y-%m-%d}/...).
+
+File names are kept, only their folder changes. Files that do not look like
+raw tweet files (e.g. max_tweet_id.json) are left where they are.
+
+if you want to see which files would be moved (dry run):
+python ds_digital_ads/pipeline/migrate_raw_layout.py
+
+if you want to copy the files to the new layout:
+python ds_digital_ads/pipeline/migrate_raw_layout.py --apply
+
+if you want to move the files (the old keys are deleted once copied):
+python ds_digital_ads/pipeline/migrate_raw_layout.py --apply --delete
+"""
+import argparse
+import re
+from typing import Optional
+
+import boto3
+
+from ds_digital_ads.utils.data_collection_utils import (
+    RAW_DATA_COLLECTION_FOLDER,
+    raw_data_folder,
+)
+from ds_digital_ads.getters.data_getters import get_s3_data_paths
+from ds_digital_ads import BUCKET_NAME
+
+RAW_FILE_NAME_PATTERN = re.compile(
+    r"^recent_search_(?P<tag>.+)_(?P<collection_datetime>\d{4}(?:_\d{2}){5})"
+    r"_production_(?P<production>true|false)\.json$"
+)
+
+
+def partitioned_key(file_path: str) -> Optional[str]:
+    """
+    Returns the partitioned S3 key of a raw file in the old flat layout.
+
+    Args:
+        file_path: S3 key of the raw file in the old layout
+    Returns:
+        S3 key in the partitioned layout, or None if the file name does not
+        match the old raw file name format.
+    """
+    file_name = file_path.split("/")[-1]
+    match = RAW_FILE_NAME_PATTERN.match(file_name)
+    if match is None:
+        return None
+
+    return (
+        raw_data_folder(
+            match["tag"],
+            match["collection_datetime"],
+            match["production"] == "true",
+        )
+        + file_name
+    )
+
+
+def migrate_raw_layout(
+    bucket_name: str = BUCKET_NAME, apply: bool = False, delete: bool = False
+) -> int:
+    """
+    Copies (and optionally deletes) every raw file directly under
+    RAW_DATA_COLLECTION_FOLDER to its partitioned key.
+
+    Args:
+        bucket_name: S3 bucket name
+        apply: whether to copy the files, otherwise only print the planned moves
+        delete: whether to delete the old keys once copied
+    Returns:
+        Number of files migrated (or to migrate if it is a dry run).
+    """
+    s3_client = boto3.client("s3")
+
+    flat_files = [
+        file_path
+        for file_path in get_s3_data_paths(
+            bucket_name, RAW_DATA_COLLECTION_FOLDER, file_types="*.json"
+        )
+        if "/" not in file_path[len(RAW_DATA_COLLECTION_FOLDER) :]
+    ]
+
+    n_files = 0
+    for file_path in flat_files:
+        new_file_path = partitioned_key(file_path)
+        if new_file_path is None:
+            print(f"skipping {file_path}")
+            continue
+
+        print(f"{file_path} -> {new_file_path}")
+        if apply:
+            s3_client.copy(
+                {"Bucket": bucket_name, "Key": file_path}, bucket_name, new_file_path
+            )
+            if delete:
+                s3_client.delete_object(Bucket=bucket_name, Key=file_path)
+        n_files += 1
+
+    print(f"{n_files} raw files {'migrated' if apply else 'to migrate (dry run)'}")
+
+    return n_files
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Move raw tweet files to the partitioned raw layout."
+    )
+    parser.add_argument(
+        "--apply",
+        action="store_true",
+        help="Copy the files, otherwise only print the planned moves",
+    )
+    parser.add_argument(
+        "--delete",
+        action="store_true",
+        help="Delete the old keys once copied (only with --apply)",
+    )
+    args = parser.parse_args()
+
+    migrate_raw_layout(apply=args.apply, delete=args.delete)
@@ -0,0 +1,224 @@
+"""
+Flow to refresh the engagement metrics of tweets that have already been collected.
+
+Ad engagement keeps growing for days after a tweet is posted, so this flow:
+    - takes the tweet ids of recent tweets from the latest core table;
+    - looks them up in batches of 100 ids per request using the tweet lookup
+      endpoint, spreading requests across the bearer token pool;
+    - appends a timestamped snapshot of their public metrics to a compact
+      time-series table partitioned by day (METRICS_SNAPSHOTS_FOLDER/date=YYYY-MM-DD/).
+
+if you want to test the flow:
+python ds_digital_ads/pipeline/refresh_metrics_flow.py run
+
+if you want to run the flow in production:
+python ds_digital_ads/pipeline/refresh_metrics_flow.py run --production True
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import os
+from typing import List
+
+import pandas as pd
+from dotenv import load_dotenv
+
+from ds_digital_ads.utils.data_collection_utils import (
+    METRICS_SNAPSHOTS_FOLDER,
+    PROCESSED_DATA_COLLECTION_FOLDER,
+    TWEET_LOOKUP_BATCH_SIZE,
+    TWEET_LOOKUP_URL,
+)
+from ds_digital_ads.utils.twitter_api_utils import (
+    TokenPool,
+    connect_to_endpoint,
+    parse_bearer_tokens,
+)
+from ds_digital_ads.utils.twitter_models import LookupResponse, to_builtins
+from ds_digital_ads.getters.data_getters import save_to_s3
+from ds_digital_ads import BUCKET_NAME
+
+from metaflow import FlowSpec, step, Parameter
+
+load_dotenv()
+
+PUBLIC_METRICS = [
+    "retweet_count",
+    "reply_count",
+    "like_count",
+    "quote_count",
+    "bookmark_count",
+    "impression_count",
+]
+
+
+def lookup_public_metrics(token_pool: TokenPool, tweet_ids: List[str]) -> List[dict]:
+    """
+    Looks up the current public metrics of a batch of tweets.
+    Tweets that have been deleted or made private are left out.
+
+    Args:
+        token_pool: pool of bearer tokens
+        tweet_ids: up to TWEET_LOOKUP_BATCH_SIZE tweet ids
+    Returns:
+        List of dictionaries with the tweet id and its public metrics.
+    """
+    json_response = connect_to_endpoint(
+        token_pool,
+        {"ids": ",".join(tweet_ids), "tweet.fields": "public_metrics"},
+        endpoint_url=TWEET_LOOKUP_URL,
+        response_type=LookupResponse,
+    )
+
+    return [
+        {"id": tweet.id, **to_builtins(tweet.public_metrics)}
+        for tweet in json_response.data
+        if tweet.public_metrics is not None
+    ]
+
+
+def metrics_snapshot_df(metrics: List[dict], snapshot_at: datetime) -> pd.DataFrame:
+    """
+    Creates a compact metrics snapshot dataframe with one row per tweet.
+
+    Args:
+        metrics: list of dictionaries with tweet ids and public metrics
+        snapshot_at: date time the snapshot was taken
+    """
+    snapshot_df = pd.DataFrame(metrics, columns=["id"] + PUBLIC_METRICS)
+    snapshot_df["id"] = snapshot_df["id"].astype("int64")
+    # impressions can outgrow 32 bit integers, the other counts cannot realistically
+    snapshot_df[PUBLIC_METRICS] = (
+        snapshot_df[PUBLIC_METRICS]
+        .fillna(0)
+        .astype({metric: "int32" for metric in PUBLIC_METRICS})
+        .astype({"impression_count": "int64"})
+    )
+    snapshot_df.insert(1, "snapshot_at", pd.Timestamp(snapshot_at))
+
+    return snapshot_df
+
+
+class RefreshMetricsFlow(FlowSpec):
+    production = Parameter("production", help="Run in production?", default=False)
+    max_age_days = Parameter(
+        "max_age_days",
+        help="Only refresh tweets posted in the last max_age_days days",
+        default=14,
+        type=int,
+    )
+    max_workers = Parameter(
+        "max_workers",
+        help="Number of lookup requests made in parallel",
+        default=4,
+        type=int,
+    )
+    bearer_token = Parameter(
+        "bearer_token",
+        help="Twitter bearer token",
+        default=os.environ.get("BEARER_TOKEN"),
+    )
+    bearer_tokens = Parameter(
+        "bearer_tokens",
+        help="Comma separated Twitter bearer tokens to pool requests across",
+        default=os.environ.get("BEARER_TOKENS"),
+    )
+
+    @step
+    def start(self):
+        """
+        Initialises bearer tokens and snapshot date time.
+        """
+        self.bearer_token_list = parse_bearer_tokens(
+            self.bearer_token, self.bearer_tokens
+        )
+        if not self.bearer_token_list:
+            print(
+                "BEARER_TOKEN or BEARER_TOKENS environment variable not set. Please set it and try again."
+            )
+        self.snapshot_at = datetime.now(timezone.utc).replace(microsecond=0)
+
+        self.next(self.load_tweet_ids)
+
+    @step
+    def load_tweet_ids(self):
+        """
+        Loads the ids of recent tweets from the latest core table.
+        """
+        from ds_digital_ads.getters.data_getters import load_s3_data, get_s3_data_paths
+
+        core_tables = get_s3_data_paths(
+            BUCKET_NAME,
+            PROCESSED_DATA_COLLECTION_FOLDER,
+            file_types=[f"*core_table_{str(self.production).lower()}_*.csv"],
+            recursive=False,
+        )
+        if not core_tables:
+            raise FileNotFoundError(
+                f"No core table found in s3://{BUCKET_NAME}/{PROCESSED_DATA_COLLECTION_FOLDER}, "
+                "run the enrich tweets flow first."
+            )
+        latest_core_table = sorted(core_tables)[-1]
+        print(f"loading tweet ids from {latest_core_table}...")
+        core_df = load_s3_data(BUCKET_NAME, latest_core_table)
+
+        created_at = pd.to_datetime(core_df["created_at"], utc=True)
+        recent = created_at >= self.snapshot_at - timedelta(days=self.max_age_days)
+        self.tweet_ids = core_df.loc[recent, "id"].astype(str).unique().tolist()
+        self.tweet_ids = (
+            self.tweet_ids
+            if self.production
+            else self.tweet_ids[:TWEET_LOOKUP_BATCH_SIZE]
+        )
+
+        self.next(self.refresh_metrics)
+
+    @step
+    def refresh_metrics(self):
+        """
+        Looks up the public metrics of the tweets in batches of 100 ids.
+        """
+        token_pool = TokenPool(self.bearer_token_list)
+
+        batches = [
+            self.tweet_ids[i : i + TWEET_LOOKUP_BATCH_SIZE]
+            for i in range(0, len(self.tweet_ids), TWEET_LOOKUP_BATCH_SIZE)
+        ]
+        print(f"refreshing metrics of {len(self.tweet_ids)} tweets...")
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            metrics = [
+                tweet_metrics
+                for batch_metrics in executor.map(
+                    lambda batch: lookup_public_metrics(token_pool, batch), batches
+                )
+                for tweet_metrics in batch_metrics
+            ]
+
+        self.snapshot_df = metrics_snapshot_df(metrics, self.snapshot_at)
+
+        self.next(self.save_data)
+
+    @step
+    def save_data(self):
+        """
+        Appends the metrics snapshot to the day partition of the snapshots table.
+        """
+        snapshot_path = os.path.join(
+            METRICS_SNAPSHOTS_FOLDER,
+            f"date={self.snapshot_at.strftime('%Y-%m-%d')}",
+            f"metrics_snapshot_production_{str(self.production).lower()}_{self.snapshot_at.strftime('%Y_%m_%d_%H_%M_%S')}.parquet",
+        )
+        print(f"saving metrics snapshot to {snapshot_path}...")
+        save_to_s3(BUCKET_NAME, self.snapshot_df, snapshot_path)
+
+        self.next(self.end)
+
+    @step
+    def end(self):
+        """
+        Ends the flow.
+        """
+        pass
+
+
+if __name__ == "__main__":
+    RefreshMetricsFlow()
@@ -104,9 +104,48 @@ TWITTER_HANDLES = [
 ]
 
 ENDPOINT_URL = "https://api.twitter.com/2/tweets/search/recent"
+TWEET_LOOKUP_URL = "https://api.twitter.com/2/tweets"
+# maximum number of tweet ids per tweet lookup request
+TWEET_LOOKUP_BATCH_SIZE = 100
 
 RAW_DATA_COLLECTION_FOLDER = "data_collection/gambling_tweets/raw/"
 PROCESSED_DATA_COLLECTION_FOLDER = "data_collection/gambling_tweets/processed/"
+METRICS_SNAPSHOTS_FOLDER = PROCESSED_DATA_COLLECTION_FOLDER + "metrics_snapshots/"
+
+
+def raw_data_folder(
+    query_tag: str,
+    collection_datetime: str,
+    production: bool,
+    root: str = RAW_DATA_COLLECTION_FOLDER,
+) -> str:
+    """
+    Returns the partitioned S3 folder of a raw data file:
+    {root}/env={production|test}/tag={query_tag}/date={%Y-%m-%d}/
+
+    Args:
+        query_tag: tag of the query the data was collected for
+        collection_datetime: collection date time (%Y_%m_%d_%H_%M_%S)
+        production: whether the data was collected in production
+        root: raw data folder of the collection
+    """
+    env = "production" if production else "test"
+    date = collection_datetime[:10].replace("_", "-")
+
+    return f"{root}env={env}/tag={query_tag}/date={date}/"
+
+
+def parse_raw_data_path(file_path: str) -> dict:
+    """
+    Parses the partition values (env, tag, date) out of a raw data file path.
+
+    Args:
+        file_path: S3 key of the raw data file
+    Returns:
+        Dictionary with the partition values found in the path.
+    """
+    return dict(part.split("=", 1) for part in file_path.split("/")[:-1] if "=" in part)
+
 
 query_parameters_twitter = {
     "tweet.fields": "id,text,author_id,attachments,conversation_id,created_at,lang,entities,geo,public_metrics,referenced_tweets",
@@ -127,3 +166,23 @@ digital_ads_ruleset_twitter = [
 """
 Utils for google ads data collection and enrichment
 """
+
+# unofficial endpoint used by the Google Ads Transparency Center website
+GOOGLE_ADS_TRANSPARENCY_URL = (
+    "https://adstransparency.google.com/anji/_/rpc/SearchService/SearchCreatives"
+)
+# geo target id of the United Kingdom
+GOOGLE_ADS_REGION_UK = 2826
+# number of creatives per page of results
+GOOGLE_ADS_PAGE_SIZE = 40
+GOOGLE_ADS_FORMATS = {1: "text", 2: "image", 3: "video"}
+
+GOOGLE_RAW_DATA_COLLECTION_FOLDER = "data_collection/gambling_google_ads/raw/"
+GOOGLE_ADS_STATE_FILE = "max_last_shown.json"
+
+# advertisers without a Google advertiser id are not collected
+google_advertiser_ids = {
+    parent_company: advertiser["google_id"]
+    for parent_company, advertiser in gambling_advertisers_uk.items()
+    if advertiser["google_id"]
+}
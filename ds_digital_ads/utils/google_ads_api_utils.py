@@ -0,0 +1,189 @@
+"""
+Utils for calling the Google Ads Transparency Center search endpoint.
+
+The endpoint is the (unofficial) RPC endpoint the Transparency Center website
+uses: requests are a POST with a json payload in the `f.req` form field whose
+keys are field numbers, and responses are json with the page of creatives under
+"1" and the next page token under "2". As the endpoint is not a public API, the
+payload and response formats may change without notice.
+
+Requests from every worker share one RateLimiter so a concurrent collection
+stays within a single request budget.
+"""
+from datetime import datetime, timezone
+import json
+import random
+import re
+import threading
+import time
+from typing import Optional
+
+import requests
+
+from ds_digital_ads.utils.data_collection_utils import (
+    GOOGLE_ADS_FORMATS,
+    GOOGLE_ADS_PAGE_SIZE,
+    GOOGLE_ADS_REGION_UK,
+    GOOGLE_ADS_TRANSPARENCY_URL,
+)
+
+# seconds to wait after the endpoint asks us to slow down (HTTP 429)
+RATE_LIMIT_SLEEP = 60
+
+_PREVIEW_URL_PATTERN = re.compile(r"""(?:src|href)=["']([^"']+)["']""")
+
+
+class RateLimiter:
+    """
+    Thread-safe rate limiter spacing requests evenly so that at most
+    `requests_per_minute` requests are made per minute across all threads.
+
+    The rate limiter holds a lock, which cannot be pickled, so flows create it
+    inside the step that uses it rather than storing it as an artifact.
+
+    Args:
+        requests_per_minute: request budget per minute
+    """
+
+    def __init__(self, requests_per_minute: float):
+        if requests_per_minute <= 0:
+            raise ValueError("requests_per_minute must be positive.")
+        self.interval = 60 / requests_per_minute
+        self._lock = threading.Lock()
+        self._next_request = 0.0
+
+    def acquire(self):
+        """
+        Reserves the next request slot, sleeping until it is due.
+        """
+        with self._lock:
+            now = time.time()
+            request_time = max(self._next_request, now)
+            self._next_request = request_time + self.interval
+        time.sleep(max(request_time - now, 0))
+
+    def pause(self, seconds: float):
+        """
+        Delays every request not yet made by at least `seconds`.
+
+        Args:
+            seconds: number of seconds to wait before the next request
+        """
+        with self._lock:
+            self._next_request = max(self._next_request, time.time() + seconds)
+
+
+def search_creatives_payload(
+    advertiser_id: str,
+    region: int = GOOGLE_ADS_REGION_UK,
+    page_size: int = GOOGLE_ADS_PAGE_SIZE,
+    page_token: Optional[str] = None,
+) -> dict:
+    """
+    Builds the form data of a request for one page of an advertiser's creatives
+    shown in a region.
+
+    Args:
+        advertiser_id: Google advertiser id (AR...)
+        region: geo target id of the region
+        page_size: number of creatives per page
+        page_token: token of the page to request, first page if None
+    """
+    request = {
+        "2": page_size,
+        "3": {"8": [region], "12": {"1": "", "2": True}, "13": {"1": [advertiser_id]}},
+        "7": {"1": 1, "2": 0, "3": region},
+    }
+    if page_token is not None:
+        request["4"] = page_token
+
+    return {"f.req": json.dumps(request)}
+
+
+def connect_to_endpoint(
+    rate_limiter: RateLimiter,
+    payload: dict,
+    endpoint_url: str = GOOGLE_ADS_TRANSPARENCY_URL,
+) -> dict:
+    """
+    Connects to the endpoint within the rate limiter's budget and requests data.
+    Returns json response if a 200 status code is yielded.
+    Backs off if the endpoint is rate limiting us, programme stops if there is a
+    problem with the request and sleeps if there is a temporary problem
+    accessing the endpoint.
+
+    Args:
+        rate_limiter: rate limiter shared by all requests
+        payload: form data of the request
+        endpoint_url: url of the endpoint (e.g. a local stand-in for testing)
+    Returns:
+        Json response from API call.
+    """
+    while True:
+        rate_limiter.acquire()
+        response = requests.post(
+            endpoint_url, params={"authuser": "0"}, data=payload, timeout=60
+        )
+        response_status_code = response.status_code
+        if response_status_code == 200:
+            return response.json()
+
+        if response_status_code == 429:
+            print(
+                "Rate limit reached, pausing requests for {} seconds...".format(
+                    RATE_LIMIT_SLEEP
+                )
+            )
+            rate_limiter.pause(RATE_LIMIT_SLEEP)
+            continue
+
+        if response_status_code >= 400 and response_status_code < 500:
+            raise Exception(
+                "Cannot get data, the program will stop!\nHTTP {}: {}".format(
+                    response_status_code, response.text
+                )
+            )
+
+        sleep_seconds = random.randint(5, 60)
+        print(
+            "Cannot get data, your program will sleep for {} seconds...\nHTTP {}: {}".format(
+                sleep_seconds, response_status_code, response.text
+            )
+        )
+        time.sleep(sleep_seconds)
+
+
+def _timestamp_to_isoformat(timestamp: Optional[dict]) -> Optional[str]:
+    if not timestamp or "1" not in timestamp:
+        return None
+    return datetime.fromtimestamp(int(timestamp["1"]), tz=timezone.utc).isoformat()
+
+
+def parse_creative(creative: dict) -> dict:
+    """
+    Flattens a creative from the search response into a record.
+
+    Args:
+        creative: creative as returned by the endpoint
+    Returns:
+        Dictionary with the creative and advertiser ids, advertiser name, ad format,
+        first and last shown date times (UTC), last shown timestamp, preview url
+        and the raw creative content.
+    """
+    content = creative.get("3", {})
+    preview_url = content.get("1", {}).get("4")
+    if preview_url is None:
+        match = _PREVIEW_URL_PATTERN.search(content.get("3", {}).get("2", ""))
+        preview_url = match.group(1) if match else None
+
+    return {
+        "creative_id": creative.get("2"),
+        "advertiser_id": creative.get("1"),
+        "advertiser_name": creative.get("12"),
+        "format": GOOGLE_ADS_FORMATS.get(creative.get("4")),
+        "first_shown": _timestamp_to_isoformat(creative.get("6")),
+        "last_shown": _timestamp_to_isoformat(creative.get("7")),
+        "last_shown_timestamp": int(creative.get("7", {}).get("1", 0)),
+        "preview_url": preview_url,
+        "content": content,
+    }
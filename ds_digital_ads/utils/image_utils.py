@@ -0,0 +1,161 @@
+"""
+Utils for extracting image features from the archived twitter images.
+
+Each image is decoded once to produce:
+    - a small JPEG thumbnail, saved to THUMBNAILS_FOLDER, so later image analysis
+      does not need to read full-size files;
+    - a 64 bit perceptual (difference) hash, so identical or near-identical
+      creatives posted under different media keys can be grouped together.
+
+Creatives are grouped in roughly linear time: each hash is split into
+HASH_CHUNKS chunks and only hashes sharing a chunk are compared, which finds
+every pair of hashes within HASH_CHUNKS - 1 bits of each other (pigeonhole
+principle) without comparing all pairs. Chunks with almost no set (or unset)
+bits, such as the all zero chunks of flat or blank images, are shared by many
+unrelated images, so they are not used to pick the hashes to compare.
+"""
+import os
+from io import BytesIO
+from typing import Dict, List, Optional
+
+import numpy as np
+from PIL import Image
+
+from ds_digital_ads import BUCKET_NAME
+from ds_digital_ads.utils.data_collection_utils import PROCESSED_DATA_COLLECTION_FOLDER
+
+IMAGES_FOLDER = os.path.join(PROCESSED_DATA_COLLECTION_FOLDER, "images")
+THUMBNAILS_FOLDER = os.path.join(PROCESSED_DATA_COLLECTION_FOLDER, "thumbnails")
+IMAGE_HASH_INDEX_FOLDER = PROCESSED_DATA_COLLECTION_FOLDER + "image_hash_index/"
+THUMBNAIL_SIZE = (256, 256)
+HASH_CHUNKS = 4
+# chunks with fewer set or unset bits than this carry too little detail to bucket on
+MIN_CHUNK_BITS = 2
+
+
+def image_hash_index_path(production: bool) -> str:
+    """
+    Returns the S3 key of the image hash index.
+
+    Args:
+        production: whether it is the production index
+    """
+    return os.path.join(
+        IMAGE_HASH_INDEX_FOLDER,
+        f"image_hash_index_production_{str(production).lower()}.json",
+    )
+
+
+def difference_hash(image: Image.Image, hash_size: int = 8) -> str:
+    """
+    Computes the difference hash of an image: the image is shrunk to
+    (hash_size + 1) x hash_size grey pixels and each bit says whether a pixel
+    is brighter than its right neighbour. Resizing, recompression and small
+    colour changes barely change the hash.
+
+    Args:
+        image: decoded image
+        hash_size: number of bits per row and column of the hash
+    Returns:
+        Hash as a hexadecimal string.
+    """
+    pixels = np.asarray(
+        image.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS),
+        dtype=np.int16,
+    )
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+
+    return "{:0{}x}".format(
+        int("".join("1" if bit else "0" for bit in bits), 2), hash_size**2 // 4
+    )
+
+
+def extract_image_features(
+    image_name: str, bucket_name: str = BUCKET_NAME
+) -> Dict[str, Optional[str]]:
+    """
+    Loads an archived image from S3, decodes it once, saves its thumbnail to S3
+    and computes its perceptual hash. Meant to be run in a process pool.
+
+    Args:
+        image_name: file name of the image in IMAGES_FOLDER
+        bucket_name: S3 bucket name
+    Returns:
+        Dictionary with the image name, perceptual hash and thumbnail path
+        (hash and path are None if the image could not be processed).
+    """
+    from ds_digital_ads.getters.data_getters import load_s3_data, save_to_s3
+
+    features = {"image_name": image_name, "phash": None, "thumbnail_path": None}
+    try:
+        image_data = load_s3_data(bucket_name, os.path.join(IMAGES_FOLDER, image_name))
+        image_data.seek(0)
+        with Image.open(image_data) as image:
+            image.load()
+            features["phash"] = difference_hash(image)
+
+            thumbnail = image.convert("RGB")
+            thumbnail.thumbnail(THUMBNAIL_SIZE)
+            thumbnail_data = BytesIO()
+            thumbnail.save(thumbnail_data, format="JPEG", quality=85)
+
+        thumbnail_path = os.path.join(
+            THUMBNAILS_FOLDER, os.path.splitext(image_name)[0] + ".jpg"
+        )
+        save_to_s3(bucket_name, thumbnail_data.getvalue(), thumbnail_path)
+        features["thumbnail_path"] = thumbnail_path
+    except Exception as e:
+        print(f"Image {image_name} could not be processed: {e}")
+
+    return features
+
+
+def _is_low_entropy(chunk: str) -> bool:
+    """Whether a hexadecimal hash chunk has almost all of its bits equal."""
+    set_bits = bin(int(chunk, 16)).count("1")
+
+    return min(set_bits, len(chunk) * 4 - set_bits) < MIN_CHUNK_BITS
+
+
+def group_similar_hashes(hashes: List[str], max_distance: int = HASH_CHUNKS - 1):
+    """
+    Groups perceptual hashes that are within max_distance bits of each other
+    (transitively). Only hashes sharing one of HASH_CHUNKS chunks are compared,
+    low entropy chunks excepted, so hashes made only of low entropy chunks
+    (e.g. of flat images) are only grouped with identical hashes.
+
+    Args:
+        hashes: hexadecimal perceptual hashes
+        max_distance: maximum number of differing bits (at most HASH_CHUNKS - 1)
+    Returns:
+        Dictionary mapping each hash to the first hash of its group.
+    """
+    unique_hashes = list(dict.fromkeys(hashes))
+    parents = list(range(len(unique_hashes)))
+
+    def find(i: int) -> int:
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    buckets = {}
+    for i, image_hash in enumerate(unique_hashes):
+        chunk_length = len(image_hash) // HASH_CHUNKS
+        for chunk in range(HASH_CHUNKS):
+            key = (chunk, image_hash[chunk * chunk_length : (chunk + 1) * chunk_length])
+            if _is_low_entropy(key[1]):
+                continue
+            for j in buckets.get(key, []):
+                distance = bin(int(image_hash, 16) ^ int(unique_hashes[j], 16)).count(
+                    "1"
+                )
+                if distance <= max_distance:
+                    root_i, root_j = find(i), find(j)
+                    # the group is named after its earliest hash
+                    parents[max(root_i, root_j)] = min(root_i, root_j)
+            buckets.setdefault(key, []).append(i)
+
+    return {
+        image_hash: unique_hashes[find(i)] for i, image_hash in enumerate(unique_hashes)
+    }
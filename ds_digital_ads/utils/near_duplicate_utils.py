@@ -0,0 +1,255 @@
+"""
+Utils for detecting near-duplicate ad copy with MinHash and locality-sensitive hashing.
+
+Advertisers repost near-identical promotional text many times. Comparing every
+pair of tweets is quadratic, so instead each tweet's text is reduced to a
+MinHash signature whose bands are hashed into LSH buckets: only tweets sharing
+a bucket are compared, and a tweet joins the campaign of its most similar
+earlier tweet if their estimated Jaccard similarity is high enough. The index
+is incremental, new tweets are matched against the existing buckets without
+recomputing anything.
+"""
+import os
+import re
+import zlib
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from ds_digital_ads import BUCKET_NAME
+from ds_digital_ads.utils.data_collection_utils import PROCESSED_DATA_COLLECTION_FOLDER
+
+CAMPAIGNS_FOLDER = PROCESSED_DATA_COLLECTION_FOLDER + "campaigns/"
+
+# largest prime below 2**32, for the universal hash functions: the hashed values
+# stay below 2**32 so they fit the uint32 signatures without wrapping around
+_PRIME = np.uint64(4294967291)
+_URL_PATTERN = re.compile(r"https?://\S+")
+_NON_WORD_PATTERN = re.compile(r"[^\w]+")
+
+
+def campaign_index_path(production: bool) -> str:
+    """
+    Returns the S3 key of the campaign index.
+
+    Args:
+        production: whether it is the production index
+    """
+    return os.path.join(
+        CAMPAIGNS_FOLDER, f"campaign_index_production_{str(production).lower()}.pkl"
+    )
+
+
+def shingles(text: Optional[str], k: int = 5) -> np.ndarray:
+    """
+    Returns the 32 bit hashes of the character k-shingles of a text, after
+    lowercasing it and removing links and punctuation (t.co links differ for
+    every repost).
+
+    Args:
+        text: text to shingle
+        k: number of characters per shingle
+    """
+    if not isinstance(text, str):
+        return np.array([], dtype=np.uint64)
+    text = _NON_WORD_PATTERN.sub(" ", _URL_PATTERN.sub(" ", text.lower())).strip()
+    if len(text) <= k:
+        return np.array([zlib.crc32(text.encode())] if text else [], dtype=np.uint64)
+
+    return np.unique(
+        np.array(
+            [zlib.crc32(text[i : i + k].encode()) for i in range(len(text) - k + 1)],
+            dtype=np.uint64,
+        )
+    )
+
+
+class CampaignIndex:
+    """
+    Incremental MinHash LSH index assigning tweets to campaigns of near-duplicate text.
+
+    Args:
+        num_perm: number of hash functions in the MinHash signatures
+        bands: number of LSH bands (num_perm must be a multiple of bands)
+        threshold: minimum estimated Jaccard similarity for two tweets to be
+            in the same campaign
+        seed: seed of the hash functions
+    """
+
+    def __init__(
+        self,
+        num_perm: int = 128,
+        bands: int = 32,
+        threshold: float = 0.7,
+        seed: int = 42,
+    ):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands.")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        self.seed = seed
+        random_state = np.random.RandomState(seed)
+        self._a = random_state.randint(1, 2**32 - 1, num_perm, dtype=np.uint64)
+        self._b = random_state.randint(0, 2**32 - 1, num_perm, dtype=np.uint64)
+
+        self.doc_ids: List[str] = []
+        self.campaign_ids: List[str] = []
+        self._doc_numbers: Dict[str, int] = {}
+        self._signatures = np.empty((0, num_perm), dtype=np.uint32)
+        self._buckets: Dict[tuple, List[int]] = {}
+        # indexed tweets whose signatures were computed with other hash functions
+        self._stale_docs = set()
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    def signature(self, text: Optional[str]) -> Optional[np.ndarray]:
+        """
+        Returns the MinHash signature of a text, or None if it has no words.
+
+        Args:
+            text: text to hash
+        """
+        hashes = shingles(text)
+        if hashes.size == 0:
+            return None
+
+        # a * h + b stays below 2**64 as a, b and h are below 2**32
+        return (
+            ((self._a[:, None] * hashes[None, :] + self._b[:, None]) % _PRIME)
+            .min(axis=1)
+            .astype(np.uint32)
+        )
+
+    def _band_keys(self, signature: np.ndarray) -> List[tuple]:
+        return [
+            (band, signature[band * self.rows : (band + 1) * self.rows].tobytes())
+            for band in range(self.bands)
+        ]
+
+    def _insert(self, doc_id: str, campaign_id: str, signature: Optional[np.ndarray]):
+        doc = len(self.doc_ids)
+        self.doc_ids.append(doc_id)
+        self.campaign_ids.append(campaign_id)
+        self._doc_numbers[doc_id] = doc
+        # grow the signatures array geometrically so inserts stay amortised O(1)
+        if doc == len(self._signatures):
+            self._signatures = np.resize(
+                self._signatures, (max(2 * doc, 1024), self.num_perm)
+            )
+        self._index_signature(doc, signature)
+
+    def _index_signature(self, doc: int, signature: Optional[np.ndarray]):
+        self._signatures[doc] = signature if signature is not None else 0
+        if signature is not None:
+            for band_key in self._band_keys(signature):
+                self._buckets.setdefault(band_key, []).append(doc)
+
+    def add(self, doc_id: str, text: Optional[str]) -> str:
+        """
+        Adds a tweet to the index and returns its campaign id. A tweet joins the
+        campaign of its most similar indexed tweet if their estimated Jaccard
+        similarity reaches the threshold, otherwise it starts a new campaign
+        whose id is the tweet's id. Tweets already indexed keep their campaign
+        (their signature is recomputed if it is stale).
+
+        Args:
+            doc_id: tweet id
+            text: tweet text
+        """
+        doc_id = str(doc_id)
+        if doc_id in self._doc_numbers:
+            doc = self._doc_numbers[doc_id]
+            if doc in self._stale_docs:
+                self._stale_docs.discard(doc)
+                self._index_signature(doc, self.signature(text))
+            return self.campaign_ids[doc]
+
+        signature = self.signature(text)
+        campaign_id = doc_id
+        if signature is not None:
+            candidates = list(
+                {
+                    doc
+                    for band_key in self._band_keys(signature)
+                    for doc in self._buckets.get(band_key, [])
+                }
+            )
+            if candidates:
+                similarities = (
+                    self._signatures[candidates] == signature[None, :]
+                ).mean(axis=1)
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    campaign_id = self.campaign_ids[candidates[best]]
+
+        self._insert(doc_id, campaign_id, signature)
+
+        return campaign_id
+
+    def to_dict(self) -> dict:
+        """
+        Returns the index as a dictionary (LSH buckets are rebuilt on load).
+        """
+        return {
+            "num_perm": self.num_perm,
+            "bands": self.bands,
+            "threshold": self.threshold,
+            "seed": self.seed,
+            "prime": int(_PRIME),
+            "doc_ids": self.doc_ids,
+            "campaign_ids": self.campaign_ids,
+            "signatures": self._signatures[: len(self.doc_ids)],
+        }
+
+    @classmethod
+    def from_dict(cls, index_dict: dict) -> "CampaignIndex":
+        """
+        Creates an index from a dictionary created by to_dict.
+
+        Args:
+            index_dict: dictionary with the index parameters, tweets and signatures
+        """
+        index = cls(
+            index_dict["num_perm"],
+            index_dict["bands"],
+            index_dict["threshold"],
+            index_dict["seed"],
+        )
+        index.doc_ids = list(index_dict["doc_ids"])
+        index.campaign_ids = list(index_dict["campaign_ids"])
+        index._doc_numbers = {doc_id: i for i, doc_id in enumerate(index.doc_ids)}
+        index._signatures = index_dict["signatures"]
+        if index_dict.get("prime") != int(_PRIME):
+            # signatures hashed with another prime cannot be compared with new
+            # ones, they are recomputed when their tweets are added again
+            index._stale_docs = set(range(len(index.doc_ids)))
+            return index
+        for doc, signature in enumerate(index._signatures):
+            # tweets without words have an all zero placeholder signature
+            if signature.any():
+                for band_key in index._band_keys(signature):
+                    index._buckets.setdefault(band_key, []).append(doc)
+
+        return index
+
+
+def get_campaign_index(production: bool = True, bucket_name: str = BUCKET_NAME):
+    """
+    Loads the campaign index from S3, or returns an empty one if it does not exist yet.
+
+    Args:
+        production: whether to load the production index
+        bucket_name: S3 bucket name
+    Returns:
+        Campaign index.
+    """
+    from ds_digital_ads.getters.data_getters import get_s3_data_paths, load_s3_data
+
+    index_path = campaign_index_path(production)
+    if index_path in get_s3_data_paths(bucket_name, index_path, file_types="*.pkl"):
+        return CampaignIndex.from_dict(load_s3_data(bucket_name, index_path))
+
+    return CampaignIndex()
@@ -0,0 +1,235 @@
+"""
+Utils for building and querying an inverted full-text index over ad tweets.
+
+The index maps each token in a tweet's text, hashtags, url titles and url
+descriptions to the tweets (and positions) it appears in, so keyword, phrase
+and boolean lookups do not need to scan the core table. Tweets are added
+incrementally and the index is stored as compact, delta-encoded gzipped json
+next to the processed data.
+
+Query syntax:
+    - free bet            tweets containing both "free" and "bet" (implicit AND)
+    - "free bet"          tweets containing the phrase "free bet"
+    - "odds boost" OR acca
+    - casino AND NOT "free spins"
+    - (bingo OR slots) AND "welcome offer"
+"""
+import os
+import re
+from typing import Dict, Iterable, List, Optional, Set
+
+from ds_digital_ads import BUCKET_NAME
+from ds_digital_ads.utils.data_collection_utils import PROCESSED_DATA_COLLECTION_FOLDER
+
+TEXT_INDEX_FOLDER = PROCESSED_DATA_COLLECTION_FOLDER + "text_index/"
+# gap between the positions of two fields so phrases cannot span fields
+FIELD_POSITION_GAP = 1000
+
+_TOKEN_PATTERN = re.compile(r"\w+")
+_QUERY_PATTERN = re.compile(r'"[^"]*"|\(|\)|[^\s()"]+')
+
+
+def tokenize(text: Optional[str]) -> List[str]:
+    """
+    Splits a text into lowercase word tokens.
+
+    Args:
+        text: text to tokenize
+    """
+    return _TOKEN_PATTERN.findall(text.lower()) if isinstance(text, str) else []
+
+
+def text_index_path(production: bool) -> str:
+    """
+    Returns the S3 key of the text index.
+
+    Args:
+        production: whether it is the production index
+    """
+    return os.path.join(
+        TEXT_INDEX_FOLDER, f"text_index_production_{str(production).lower()}.json.gz"
+    )
+
+
+class InvertedIndex:
+    """
+    Positional inverted index over documents (tweets) made of several text fields.
+
+    Postings are kept delta-encoded as flat lists of integers
+    ([doc gap, number of positions, position gaps...] per document) and only
+    decoded for the tokens a query or an update touches.
+
+    Args:
+        doc_ids: ids of the indexed documents
+        postings: encoded postings per token
+    """
+
+    def __init__(
+        self,
+        doc_ids: Optional[List[str]] = None,
+        postings: Optional[Dict[str, List[int]]] = None,
+    ):
+        self.doc_ids = list(doc_ids or [])
+        self._doc_numbers = {doc_id: i for i, doc_id in enumerate(self.doc_ids)}
+        self._encoded = dict(postings or {})
+        self._decoded = {}
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    def __contains__(self, doc_id: str) -> bool:
+        return str(doc_id) in self._doc_numbers
+
+    @staticmethod
+    def _encode(postings: Dict[int, List[int]]) -> List[int]:
+        encoded, previous_doc = [], 0
+        for doc in sorted(postings):
+            positions = postings[doc]
+            encoded += [doc - previous_doc, len(positions), positions[0]]
+            encoded += [b - a for a, b in zip(positions, positions[1:])]
+            previous_doc = doc
+        return encoded
+
+    @staticmethod
+    def _decode(encoded: List[int]) -> Dict[int, List[int]]:
+        postings, doc, i = {}, 0, 0
+        while i < len(encoded):
+            doc += encoded[i]
+            n_positions = encoded[i + 1]
+            positions = [encoded[i + 2]]
+            for gap in encoded[i + 3 : i + 2 + n_positions]:
+                positions.append(positions[-1] + gap)
+            postings[doc] = positions
+            i += 2 + n_positions
+        return postings
+
+    def _postings(self, token: str) -> Dict[int, List[int]]:
+        if token not in self._decoded:
+            self._decoded[token] = self._decode(self._encoded.get(token, []))
+        return self._decoded[token]
+
+    def add_document(self, doc_id: str, fields: Iterable[Optional[str]]) -> bool:
+        """
+        Adds a document to the index, unless it is already indexed.
+
+        Args:
+            doc_id: document (tweet) id
+            fields: texts of the document's fields
+        Returns:
+            Whether the document was added.
+        """
+        doc_id = str(doc_id)
+        if doc_id in self._doc_numbers:
+            return False
+
+        doc = len(self.doc_ids)
+        self.doc_ids.append(doc_id)
+        self._doc_numbers[doc_id] = doc
+        for field_number, field in enumerate(fields):
+            offset = field_number * FIELD_POSITION_GAP
+            for position, token in enumerate(tokenize(field)):
+                self._postings(token).setdefault(doc, []).append(offset + position)
+
+        return True
+
+    def _phrase(self, tokens: List[str]) -> Set[int]:
+        if not tokens:
+            return set()
+        postings = [self._postings(token) for token in tokens]
+        docs = set(postings[0]).intersection(*postings[1:])
+        if len(tokens) == 1:
+            return docs
+
+        matches = set()
+        for doc in docs:
+            positions = [set(token_postings[doc]) for token_postings in postings[1:]]
+            if any(
+                all(start + i + 1 in positions[i] for i in range(len(positions)))
+                for start in postings[0][doc]
+            ):
+                matches.add(doc)
+
+        return matches
+
+    def search(self, query: str) -> List[str]:
+        """
+        Returns the ids of the documents matching a query, in the order they were
+        indexed. See the module docstring for the query syntax.
+
+        Args:
+            query: keyword, phrase or boolean query
+        """
+        terms = _QUERY_PATTERN.findall(query)
+        docs, i = self._parse_or(terms, 0)
+        if i != len(terms):
+            raise ValueError(f"Could not parse query: {query}")
+
+        return [self.doc_ids[doc] for doc in sorted(docs)]
+
+    def _parse_or(self, terms: List[str], i: int) -> tuple:
+        docs, i = self._parse_and(terms, i)
+        while i < len(terms) and terms[i] == "OR":
+            other_docs, i = self._parse_and(terms, i + 1)
+            docs = docs | other_docs
+        return docs, i
+
+    def _parse_and(self, terms: List[str], i: int) -> tuple:
+        docs, i = self._parse_not(terms, i)
+        while i < len(terms) and terms[i] not in ("OR", ")"):
+            if terms[i] == "AND":
+                i += 1
+            other_docs, i = self._parse_not(terms, i)
+            docs = docs & other_docs
+        return docs, i
+
+    def _parse_not(self, terms: List[str], i: int) -> tuple:
+        if i >= len(terms):
+            raise ValueError("Unexpected end of query")
+        if terms[i] == "NOT":
+            docs, i = self._parse_not(terms, i + 1)
+            return set(range(len(self.doc_ids))) - docs, i
+        if terms[i] == "(":
+            docs, i = self._parse_or(terms, i + 1)
+            if i >= len(terms) or terms[i] != ")":
+                raise ValueError("Missing closing parenthesis in query")
+            return docs, i + 1
+        return self._phrase(tokenize(terms[i].strip('"'))), i + 1
+
+    def to_dict(self) -> dict:
+        """
+        Returns the index as a compact json serialisable dictionary.
+        """
+        postings = dict(self._encoded)
+        postings.update(
+            {token: self._encode(docs) for token, docs in self._decoded.items() if docs}
+        )
+        return {"doc_ids": self.doc_ids, "postings": postings}
+
+    @classmethod
+    def from_dict(cls, index_dict: dict) -> "InvertedIndex":
+        """
+        Creates an index from a dictionary created by to_dict.
+
+        Args:
+            index_dict: dictionary with doc ids and encoded postings
+        """
+        return cls(index_dict["doc_ids"], index_dict["postings"])
+
+
+def get_text_index(production: bool = True, bucket_name: str = BUCKET_NAME):
+    """
+    Loads the text index from S3, or returns an empty one if it does not exist yet.
+
+    Args:
+        production: whether to load the production index
+        bucket_name: S3 bucket name
+    Returns:
+        Inverted index.
+    """
+    from ds_digital_ads.getters.data_getters import get_s3_data_paths, load_s3_data
+
+    index_path = text_index_path(production)
+    if index_path in get_s3_data_paths(bucket_name, index_path, file_types="*.gz"):
+        return InvertedIndex.from_dict(load_s3_data(bucket_name, index_path))
+
+    return InvertedIndex()
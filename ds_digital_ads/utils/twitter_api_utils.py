@@ -0,0 +1,240 @@
+"""
+Utils for calling the Twitter API with a pool of bearer tokens.
+
+Each app credential has its own rate-limit window, so spreading requests
+across several tokens scales collection throughput with the number of
+credentials. The pool tracks each token's remaining budget from the
+`x-rate-limit-*` response headers and fails over to another token when one
+is exhausted (HTTP 429) or revoked (HTTP 401/403).
+"""
+import random
+import threading
+import time
+from typing import List, Optional, Type
+
+import msgspec
+import requests
+
+from ds_digital_ads.utils.data_collection_utils import ENDPOINT_URL
+from ds_digital_ads.utils.twitter_models import SearchResponse
+
+# minimum number of seconds between two requests made with the same token
+MIN_REQUEST_INTERVAL = 2
+
+
+def parse_bearer_tokens(*token_strings: Optional[str]) -> List[str]:
+    """
+    Parses one or more comma separated strings of bearer tokens into a list of
+    unique tokens, preserving their order.
+
+    Args:
+        token_strings: strings with one or more comma separated bearer tokens
+    Returns:
+        List of unique bearer tokens.
+    """
+    tokens = []
+    for token_string in token_strings:
+        if not token_string:
+            continue
+        for token in token_string.split(","):
+            token = token.strip()
+            if token and token not in tokens:
+                tokens.append(token)
+
+    return tokens
+
+
+def request_headers(bearer_token: str) -> dict:
+    """
+    Set up the request headers.
+    Returns a dictionary summarising the bearer token authentication details.
+
+    Args:
+        bearer_token: bearer token credentials
+    """
+    return {"Authorization": "Bearer {}".format(bearer_token)}
+
+
+class TokenPool:
+    """
+    Thread-safe pool of bearer tokens that spreads requests across tokens.
+
+    Tokens are picked by largest remaining budget. A token is unavailable
+    while its budget is exhausted (until its window resets), while it is within
+    `min_interval` seconds of its previous request, or once it has been revoked.
+
+    The pool holds a lock, which cannot be pickled, so flows create it inside the
+    step that uses it rather than storing it as an artifact.
+
+    Args:
+        bearer_tokens: list of bearer tokens
+        min_interval: minimum number of seconds between two requests made with
+            the same token
+    """
+
+    def __init__(
+        self, bearer_tokens: List[str], min_interval: float = MIN_REQUEST_INTERVAL
+    ):
+        if not bearer_tokens:
+            raise ValueError("The token pool needs at least one bearer token.")
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._tokens = {
+            token: {"remaining": None, "reset": 0.0, "next_request": 0.0}
+            for token in bearer_tokens
+        }
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._tokens)
+
+    def acquire(self) -> str:
+        """
+        Returns the available token with the largest remaining budget, sleeping
+        until one becomes available if needed.
+        """
+        while True:
+            with self._lock:
+                if not self._tokens:
+                    raise Exception(
+                        "All bearer tokens have been revoked, the program will stop!"
+                    )
+                now = time.time()
+                available = [
+                    (token, state)
+                    for token, state in self._tokens.items()
+                    if state["next_request"] <= now
+                    and (state["remaining"] != 0 or state["reset"] <= now)
+                ]
+                if available:
+                    token, state = max(
+                        available,
+                        key=lambda x: float("inf")
+                        if x[1]["remaining"] is None or x[1]["reset"] <= now
+                        else x[1]["remaining"],
+                    )
+                    if state["remaining"] is not None and state["reset"] > now:
+                        # reserve one request from the budget until headers arrive
+                        state["remaining"] -= 1
+                    state["next_request"] = now + self.min_interval
+                    return token
+
+                wake_up = min(
+                    max(
+                        state["next_request"],
+                        state["reset"] if state["remaining"] == 0 else 0.0,
+                    )
+                    for state in self._tokens.values()
+                )
+            time.sleep(max(wake_up - time.time(), 0.1))
+
+    def update(self, token: str, response_headers: dict):
+        """
+        Updates a token's remaining budget from the rate limit response headers.
+
+        Args:
+            token: bearer token used for the request
+            response_headers: headers of the response
+        """
+        remaining = response_headers.get("x-rate-limit-remaining")
+        reset = response_headers.get("x-rate-limit-reset")
+        with self._lock:
+            if token not in self._tokens:
+                return
+            if remaining is not None:
+                self._tokens[token]["remaining"] = int(remaining)
+            if reset is not None:
+                self._tokens[token]["reset"] = float(reset)
+
+    def exhaust(self, token: str, response_headers: dict):
+        """
+        Marks a token as exhausted until its rate limit window resets.
+
+        Args:
+            token: bearer token that hit its rate limit
+            response_headers: headers of the (HTTP 429) response
+        """
+        reset = response_headers.get("x-rate-limit-reset")
+        with self._lock:
+            if token not in self._tokens:
+                return
+            self._tokens[token]["remaining"] = 0
+            self._tokens[token]["reset"] = (
+                float(reset) if reset is not None else time.time() + 15 * 60
+            )
+
+    def revoke(self, token: str):
+        """
+        Removes a token that is no longer authorised from the pool.
+
+        Args:
+            token: bearer token to remove
+        """
+        with self._lock:
+            self._tokens.pop(token, None)
+
+
+def connect_to_endpoint(
+    token_pool: TokenPool,
+    parameters: dict,
+    endpoint_url: str = ENDPOINT_URL,
+    response_type: Type[msgspec.Struct] = SearchResponse,
+) -> msgspec.Struct:
+    """
+    Connects to the endpoint and requests data using a token from the pool.
+    Returns the response decoded into a typed model if a 200 status code is yielded
+    (a msgspec.ValidationError is raised if the response does not match the model).
+    Fails over to another token if the current one is rate limited or revoked,
+    programme stops if there is a problem with the request and sleeps
+    if there is a temporary problem accessing the endpoint.
+
+    Args:
+        token_pool: pool of bearer tokens
+        parameters: query parameters
+        endpoint_url: url of the endpoint
+        response_type: model to decode the response into
+    Returns:
+        Typed json response from API call.
+    """
+    while True:
+        token = token_pool.acquire()
+        response = requests.request(
+            "GET",
+            url=endpoint_url,
+            headers=request_headers(token),
+            params=parameters,
+            timeout=60,
+        )
+        response_status_code = response.status_code
+        if response_status_code == 200:
+            token_pool.update(token, response.headers)
+            return msgspec.json.decode(response.content, type=response_type)
+
+        if response_status_code == 429:
+            print("Rate limit reached for one of the tokens, switching token...")
+            token_pool.exhaust(token, response.headers)
+            continue
+
+        if response_status_code in (401, 403):
+            print(
+                "One of the tokens was rejected (HTTP {}), removing it from the pool...".format(
+                    response_status_code
+                )
+            )
+            token_pool.revoke(token)
+            continue
+
+        if response_status_code >= 400 and response_status_code < 500:
+            raise Exception(
+                "Cannot get data, the program will stop!\nHTTP {}: {}".format(
+                    response_status_code, response.text
+                )
+            )
+
+        sleep_seconds = random.randint(5, 60)
+        print(
+            "Cannot get data, your program will sleep for {} seconds...\nHTTP {}: {}".format(
+                sleep_seconds, response_status_code, response.text
+            )
+        )
+        time.sleep(sleep_seconds)
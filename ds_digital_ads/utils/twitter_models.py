@@ -0,0 +1,229 @@
+"""
+Typed models of the Twitter API v2 responses used by the collect and enrich flows.
+
+Responses are decoded straight from bytes into msgspec structs (which use
+__slots__ and are much cheaper than nested dicts), so parsing and serialisation
+happen once per response, and schema drift (e.g. a field changing type) raises
+a msgspec.ValidationError at decode time instead of failing later in pandas.
+
+Unknown fields are forbidden: raw files are re-encoded from the models, so a
+field the models do not declare (e.g. a field newly returned by the API or added
+to the requested fields) raises at decode time rather than being silently
+dropped from the raw archive. Such a field has to be added to its model.
+
+Fields default to None (or an empty list) and are omitted when encoding if
+unset, so a decoded and re-encoded response has the same shape as the
+original. Nested fields we do not use are kept as plain dictionaries or lists.
+"""
+from typing import Any, Dict, List, Optional
+
+import msgspec
+
+
+class _Model(msgspec.Struct, omit_defaults=True, forbid_unknown_fields=True):
+    """Base struct: unset fields are not encoded and unknown fields raise."""
+
+
+class TweetPublicMetrics(_Model):
+    retweet_count: Optional[int] = None
+    reply_count: Optional[int] = None
+    like_count: Optional[int] = None
+    quote_count: Optional[int] = None
+    bookmark_count: Optional[int] = None
+    impression_count: Optional[int] = None
+
+
+class Hashtag(_Model):
+    tag: str
+    start: Optional[int] = None
+    end: Optional[int] = None
+
+
+class Mention(_Model):
+    username: str
+    id: Optional[str] = None
+    start: Optional[int] = None
+    end: Optional[int] = None
+
+
+class Url(_Model):
+    url: Optional[str] = None
+    expanded_url: Optional[str] = None
+    display_url: Optional[str] = None
+    unwound_url: Optional[str] = None
+    title: Optional[str] = None
+    description: Optional[str] = None
+    status: Optional[int] = None
+    media_key: Optional[str] = None
+    images: Optional[List[Dict[str, Any]]] = None
+    start: Optional[int] = None
+    end: Optional[int] = None
+
+
+class Entities(_Model):
+    hashtags: List[Hashtag] = []
+    mentions: List[Mention] = []
+    urls: List[Url] = []
+    cashtags: Optional[List[Dict[str, Any]]] = None
+    annotations: Optional[List[Dict[str, Any]]] = None
+
+
+class Attachments(_Model):
+    media_keys: List[str] = []
+    poll_ids: Optional[List[str]] = None
+
+
+class Tweet(_Model):
+    id: str
+    text: str
+    author_id: Optional[str] = None
+    conversation_id: Optional[str] = None
+    created_at: Optional[str] = None
+    lang: Optional[str] = None
+    attachments: Optional[Attachments] = None
+    entities: Optional[Entities] = None
+    public_metrics: Optional[TweetPublicMetrics] = None
+    geo: Optional[Dict[str, Any]] = None
+    referenced_tweets: Optional[List[Dict[str, Any]]] = None
+    in_reply_to_user_id: Optional[str] = None
+    possibly_sensitive: Optional[bool] = None
+    reply_settings: Optional[str] = None
+    withheld: Optional[Dict[str, Any]] = None
+    edit_history_tweet_ids: Optional[List[str]] = None
+
+
+class MediaPublicMetrics(_Model):
+    view_count: Optional[int] = None
+
+
+class Media(_Model):
+    media_key: str
+    type: Optional[str] = None
+    url: Optional[str] = None
+    preview_image_url: Optional[str] = None
+    duration_ms: Optional[int] = None
+    height: Optional[int] = None
+    width: Optional[int] = None
+    alt_text: Optional[str] = None
+    public_metrics: Optional[MediaPublicMetrics] = None
+    variants: Optional[List[Dict[str, Any]]] = None
+
+
+class UserPublicMetrics(_Model):
+    followers_count: Optional[int] = None
+    following_count: Optional[int] = None
+    tweet_count: Optional[int] = None
+    listed_count: Optional[int] = None
+    like_count: Optional[int] = None
+
+
+class User(_Model):
+    id: str
+    username: str
+    name: Optional[str] = None
+    created_at: Optional[str] = None
+    description: Optional[str] = None
+    location: Optional[str] = None
+    url: Optional[str] = None
+    verified: Optional[bool] = None
+    protected: Optional[bool] = None
+    profile_image_url: Optional[str] = None
+    public_metrics: Optional[UserPublicMetrics] = None
+    entities: Optional[Dict[str, Any]] = None
+    withheld: Optional[Dict[str, Any]] = None
+
+
+class Place(_Model):
+    id: str
+    full_name: Optional[str] = None
+    name: Optional[str] = None
+    country: Optional[str] = None
+    country_code: Optional[str] = None
+    place_type: Optional[str] = None
+    geo: Optional[Dict[str, Any]] = None
+    contained_within: Optional[List[str]] = None
+
+
+class Includes(_Model):
+    users: List[User] = []
+    places: List[Place] = []
+    media: List[Media] = []
+
+
+class Meta(_Model):
+    newest_id: Optional[str] = None
+    oldest_id: Optional[str] = None
+    result_count: Optional[int] = None
+    next_token: Optional[str] = None
+
+
+class SearchResponse(_Model):
+    """Recent search response, also used for the collected (merged) raw data."""
+
+    data: List[Tweet] = []
+    includes: Includes = msgspec.field(default_factory=Includes)
+    meta: Meta = msgspec.field(default_factory=Meta)
+    errors: Optional[List[Dict[str, Any]]] = None
+
+
+class LookupResponse(_Model):
+    """Tweet lookup response."""
+
+    data: List[Tweet] = []
+    errors: Optional[List[Dict[str, Any]]] = None
+
+
+_encoder = msgspec.json.Encoder()
+_search_response_decoder = msgspec.json.Decoder(SearchResponse)
+
+
+def decode_search_response(content: bytes) -> SearchResponse:
+    """
+    Decodes a recent search response (or a raw data file) into typed models.
+
+    Args:
+        content: json bytes
+    """
+    return _search_response_decoder.decode(content)
+
+
+def encode_response(response: msgspec.Struct) -> bytes:
+    """
+    Encodes a response model back into json bytes.
+
+    Args:
+        response: response model
+    """
+    return _encoder.encode(response)
+
+
+def flatten_model(model: msgspec.Struct, prefix: str = "") -> Dict[str, Any]:
+    """
+    Flattens a model into a record read straight from its attributes: nested
+    models become prefixed columns (e.g. public_metrics_followers_count) and,
+    as when encoding, unset fields are left out.
+
+    Args:
+        model: model to flatten
+        prefix: prefix of the record keys
+    """
+    record = {}
+    for field in model.__struct_fields__:
+        value = getattr(model, field)
+        if isinstance(value, msgspec.Struct):
+            record.update(flatten_model(value, f"{prefix}{field}_"))
+        elif value is not None:
+            record[f"{prefix}{field}"] = value
+
+    return record
+
+
+def to_builtins(model: Any) -> Any:
+    """
+    Converts a model, or a list of models, into dictionaries of builtin types
+    (e.g. for pandas).
+
+    Args:
+        model: response model or list of models
+    """
+    return msgspec.to_builtins(model)